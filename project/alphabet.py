@@ -0,0 +1,40 @@
+from typing import Hashable, List, Optional
+from pyformlang.finite_automaton import Symbol
+
+
+class Alphabet:
+    _symbol_to_id: dict[Symbol, int]
+    _symbols: List[Symbol]
+
+    def __init__(self, symbols: List[Symbol] = None):
+        self._symbol_to_id = dict()
+        self._symbols = []
+        for symbol in symbols or []:
+            self.intern(symbol)
+
+    def find(self, label: Hashable) -> Optional[int]:
+        # Symbol hashes and compares as its value, so raw labels are found too
+        return self._symbol_to_id.get(label)
+
+    def intern(self, label: Hashable) -> int:
+        symbol_id = self._symbol_to_id.get(label)
+        if symbol_id is None:
+            symbol = label if isinstance(label, Symbol) else Symbol(label)
+            symbol_id = len(self._symbols)
+            self._symbols.append(symbol)
+            self._symbol_to_id[symbol] = symbol_id
+        return symbol_id
+
+    def symbol(self, symbol_id: int) -> Symbol:
+        return self._symbols[symbol_id]
+
+    @property
+    def symbols(self) -> List[Symbol]:
+        return self._symbols
+
+    def __len__(self) -> int:
+        return len(self._symbols)
+
+
+# shared by all automata, so that their matrices are indexed by the same ids
+ALPHABET = Alphabet()
@@ -0,0 +1,293 @@
+from abc import ABC, abstractmethod
+from typing import Generic, Optional, TypeVar, Union
+import numpy as np
+import scipy.sparse as sp
+
+Matrix = TypeVar("Matrix")
+
+
+def csr_rows_indices(matrix: sp.csr_matrix, rows: np.ndarray) -> np.ndarray:
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return matrix.indices[offsets + np.arange(len(offsets))]
+
+
+class MatrixBackend(ABC, Generic[Matrix]):
+    # boolean matrix operations the CFPQ and RPQ algorithms are written with
+    name: str
+    # memory taken by one true entry, or by any entry for dense backends
+    entry_bytes: float
+
+    @abstractmethod
+    def build(
+        self, shape: tuple[int, int], rows: np.ndarray, cols: np.ndarray
+    ) -> Matrix: ...
+
+    @abstractmethod
+    def convert(self, matrix) -> Matrix: ...
+
+    @abstractmethod
+    def multiply(self, left: Matrix, right: Matrix) -> Matrix: ...
+
+    @abstractmethod
+    def add(self, left: Matrix, right: Matrix) -> Matrix: ...
+
+    @abstractmethod
+    def difference(self, left: Matrix, right: Matrix) -> Matrix: ...
+
+    @abstractmethod
+    def nnz(self, matrix: Matrix) -> int: ...
+
+    @abstractmethod
+    def extract_pairs(self, matrix: Matrix) -> tuple[np.ndarray, np.ndarray]: ...
+
+    def empty(self, shape: tuple[int, int]) -> Matrix:
+        return self.build(shape, np.empty(0, np.int64), np.empty(0, np.int64))
+
+    def map_rows(self, matrix: Matrix, transition: sp.csr_matrix) -> Matrix:
+        # rows go in blocks of transition size, row q of every block is
+        # moved to the rows transition[q] of the same block
+        rows, cols = self.extract_pairs(matrix)
+        blocks, states = np.divmod(rows, transition.shape[0])
+        lengths = np.diff(transition.indptr)[states]
+        targets = csr_rows_indices(transition, states)
+        return self.build(
+            matrix.shape,
+            np.repeat(blocks * transition.shape[0], lengths) + targets,
+            np.repeat(cols, lengths),
+        )
+
+
+class ScipySparseBackend(MatrixBackend):
+    # int32 column index and bool value
+    entry_bytes = 5
+
+    def __init__(self, matrix_type=sp.csr_matrix):
+        self.matrix_type = matrix_type
+        self.name = matrix_type((1, 1)).format
+
+    def build(self, shape, rows, cols):
+        return self.matrix_type(
+            sp.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=shape)
+        )
+
+    def convert(self, matrix):
+        matrix = sp.csr_matrix(matrix, dtype=bool, copy=True)
+        matrix.eliminate_zeros()
+        return self.matrix_type(matrix)
+
+    def multiply(self, left, right):
+        return left @ right
+
+    def add(self, left, right):
+        return left + right
+
+    def difference(self, left, right):
+        return left > right
+
+    def nnz(self, matrix):
+        return matrix.count_nonzero()
+
+    def extract_pairs(self, matrix):
+        rows, cols = matrix.nonzero()
+        return rows.astype(np.int64), cols.astype(np.int64)
+
+
+class BitMatrix:
+    # boolean matrix with every row packed into little endian uint64 words
+    shape: tuple[int, int]
+    words: np.ndarray
+
+    def __init__(self, shape: tuple[int, int], words: np.ndarray = None):
+        self.shape = shape
+        if words is None:
+            words = np.zeros((shape[0], (shape[1] + 63) // 64), dtype=np.uint64)
+        self.words = words
+
+    def get(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        cols = np.asarray(cols, dtype=np.uint64)
+        words = self.words[rows, (cols >> np.uint64(6)).astype(np.int64)]
+        return (words >> (cols & np.uint64(63))) & np.uint64(1) == 1
+
+    def set(self, rows: np.ndarray, cols: np.ndarray):
+        cols = np.asarray(cols, dtype=np.uint64)
+        np.bitwise_or.at(
+            self.words,
+            (np.asarray(rows, dtype=np.int64), (cols >> np.uint64(6)).astype(np.int64)),
+            np.left_shift(np.uint64(1), cols & np.uint64(63)),
+        )
+
+
+MULTIPLY_CHUNK_WORDS = 1 << 22
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+class BitPackedBackend(MatrixBackend[BitMatrix]):
+    # dense storage, meant for automata small enough to keep n^2 bits
+    name = "bitpacked"
+    entry_bytes = 1 / 8
+
+    def build(self, shape, rows, cols):
+        matrix = BitMatrix(shape)
+        matrix.set(rows, cols)
+        return matrix
+
+    def convert(self, matrix):
+        if isinstance(matrix, BitMatrix):
+            return matrix
+        coo = sp.coo_matrix(matrix)
+        non_zero = coo.data != 0
+        return self.build(coo.shape, coo.row[non_zero], coo.col[non_zero])
+
+    def multiply(self, left, right):
+        result = BitMatrix((left.shape[0], right.shape[1]))
+        rows, cols = self.extract_pairs(left)
+        # every true entry (r, c) of left ORs row c of right into row r,
+        # gathered rows are limited to MULTIPLY_CHUNK_WORDS at a time
+        chunk = max(MULTIPLY_CHUNK_WORDS // max(right.words.shape[1], 1), 1)
+        for begin in range(0, len(rows), chunk):
+            chunk_rows = rows[begin : begin + chunk]
+            starts = np.flatnonzero(np.r_[True, chunk_rows[1:] != chunk_rows[:-1]])
+            np.bitwise_or.at(
+                result.words,
+                chunk_rows[starts],
+                np.bitwise_or.reduceat(
+                    right.words[cols[begin : begin + chunk]], starts, axis=0
+                ),
+            )
+        return result
+
+    def add(self, left, right):
+        return BitMatrix(left.shape, left.words | right.words)
+
+    def map_rows(self, matrix, transition):
+        block_size = transition.shape[0]
+        blocks = matrix.words.reshape(-1, block_size, matrix.words.shape[1])
+        result = np.zeros_like(blocks)
+        coo = transition.tocoo()
+        for source, target in zip(coo.row.tolist(), coo.col.tolist()):
+            result[:, target] |= blocks[:, source]
+        return BitMatrix(matrix.shape, result.reshape(matrix.words.shape))
+
+    def difference(self, left, right):
+        return BitMatrix(left.shape, left.words & ~right.words)
+
+    def nnz(self, matrix):
+        return int(_POPCOUNT[matrix.words.view(np.uint8)].sum())
+
+    def extract_pairs(self, matrix):
+        # only non zero words are unpacked, pairs come in row major order
+        rows, word_cols = np.nonzero(matrix.words)
+        bits = np.unpackbits(
+            matrix.words[rows, word_cols].astype("<u8").view(np.uint8).reshape(-1, 8),
+            axis=1,
+            bitorder="little",
+        )
+        word_indices, bit_indices = np.nonzero(bits)
+        return (
+            rows[word_indices].astype(np.int64),
+            word_cols[word_indices].astype(np.int64) * 64 + bit_indices,
+        )
+
+
+# a sparse entry takes ScipySparseBackend.entry_bytes, a packed one a single bit
+DENSE_VISITED_RATIO = 1 / (8 * ScipySparseBackend.entry_bytes)
+
+
+class VisitedMatrix:
+    # visited entries of a BFS: kept in the backend format while they are
+    # rare, packed into uint64 words for good once dense enough, after which
+    # fronts are filtered and merged in place
+    _backend: MatrixBackend
+    _sparse: Optional[Matrix]
+    _bits: Optional[BitMatrix]
+    _scratch: Optional[np.ndarray]
+
+    def __init__(
+        self,
+        backend: MatrixBackend,
+        front: Matrix,
+        dense_ratio: float = DENSE_VISITED_RATIO,
+    ):
+        self._backend = backend
+        self._dense_ratio = dense_ratio
+        self._sparse = front
+        self._bits = None
+        self._scratch = None
+        self.__pack_if_dense()
+
+    def __pack(self):
+        bits = _BIT_PACKED.convert(self._sparse)
+        self._bits = BitMatrix(bits.shape, bits.words.copy())
+        self._scratch = np.empty_like(self._bits.words)
+        self._sparse = None
+
+    def __pack_if_dense(self):
+        rows_number, cols_number = self._sparse.shape
+        if self._backend.nnz(self._sparse) >= (
+            self._dense_ratio * rows_number * cols_number
+        ):
+            self.__pack()
+
+    def update(self, front: Matrix) -> Matrix:
+        # returns the part of front not visited before and marks it visited
+        backend = self._backend
+        if self._bits is None:
+            front = backend.difference(front, self._sparse)
+            self._sparse = backend.add(self._sparse, front)
+            self.__pack_if_dense()
+            return front
+
+        if isinstance(front, BitMatrix):
+            np.invert(self._bits.words, out=self._scratch)
+            np.bitwise_and(front.words, self._scratch, out=front.words)
+            np.bitwise_or(self._bits.words, front.words, out=self._bits.words)
+            return front
+
+        rows, cols = backend.extract_pairs(front)
+        fresh = ~self._bits.get(rows, cols)
+        rows, cols = rows[fresh], cols[fresh]
+        self._bits.set(rows, cols)
+        return backend.build(front.shape, rows, cols)
+
+    def extract_pairs(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._bits is None:
+            return self._backend.extract_pairs(self._sparse)
+        return _BIT_PACKED.extract_pairs(self._bits)
+
+    def unvisited_pairs(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._bits is None:
+            self.__pack()
+        np.invert(self._bits.words, out=self._scratch)
+        # bits past the last column are padding, not unvisited entries
+        tail = self._bits.shape[1] % 64
+        if tail:
+            self._scratch[:, -1] &= np.uint64((1 << tail) - 1)
+        return _BIT_PACKED.extract_pairs(BitMatrix(self._bits.shape, self._scratch))
+
+    def matrix(self) -> Matrix:
+        if self._bits is None:
+            return self._sparse
+        return self._backend.build(self._bits.shape, *self.extract_pairs())
+
+
+_BIT_PACKED = BitPackedBackend()
+
+BACKENDS: dict[str, MatrixBackend] = {
+    "csr": ScipySparseBackend(sp.csr_matrix),
+    "bitpacked": _BIT_PACKED,
+}
+
+
+def get_backend(
+    backend: Union[str, MatrixBackend, None], matrix_type=sp.csr_matrix
+) -> MatrixBackend:
+    if backend is None:
+        return ScipySparseBackend(matrix_type)
+    if isinstance(backend, MatrixBackend):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown matrix backend: {backend}")
+    return BACKENDS[backend]
@@ -0,0 +1,110 @@
+from collections.abc import Set
+from typing import Hashable, Iterable, Iterator, Optional, Sequence, Union
+import numpy as np
+
+# pairs are converted to tuples by slices of this size while iterating
+ITERATION_CHUNK = 1 << 16
+
+
+def _object_array(values: Sequence[Hashable]) -> np.ndarray:
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def node_array(nodes: Sequence[Hashable]) -> np.ndarray:
+    # int64 when every node id is an integer, object array otherwise
+    nodes = list(nodes)
+    if all(isinstance(node, (int, np.integer)) for node in nodes):
+        return np.array(nodes, dtype=np.int64)
+    return _object_array(nodes)
+
+
+class NodePairs(Set):
+    # set of (source, target) node pairs kept as two NumPy columns,
+    # sorted and without repeats when the node ids are integers
+    _sources: np.ndarray
+    _targets: np.ndarray
+    _index: Optional[set]
+
+    def __init__(self, sources: np.ndarray, targets: np.ndarray):
+        sources, targets = np.asarray(sources), np.asarray(targets)
+        if sources.dtype == object or targets.dtype == object:
+            unique = dict.fromkeys(zip(sources.tolist(), targets.tolist()))
+            self._sources = _object_array([source for source, _ in unique])
+            self._targets = _object_array([target for _, target in unique])
+        else:
+            sources, targets = sources.astype(np.int64), targets.astype(np.int64)
+            order = np.lexsort((targets, sources))
+            sources, targets = sources[order], targets[order]
+            distinct = np.ones(len(sources), dtype=bool)
+            distinct[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+            self._sources, self._targets = sources[distinct], targets[distinct]
+        self._index = None
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[tuple[Hashable, Hashable]]) -> "NodePairs":
+        pairs = list(pairs)
+        return cls(
+            node_array([source for source, _ in pairs]),
+            node_array([target for _, target in pairs]),
+        )
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return cls.from_pairs(iterable)
+
+    @property
+    def sources(self) -> np.ndarray:
+        return self._sources
+
+    @property
+    def targets(self) -> np.ndarray:
+        return self._targets
+
+    def __len__(self) -> int:
+        return len(self._sources)
+
+    def __iter__(self) -> Iterator[tuple[Hashable, Hashable]]:
+        for begin in range(0, len(self._sources), ITERATION_CHUNK):
+            end = begin + ITERATION_CHUNK
+            yield from zip(
+                self._sources[begin:end].tolist(), self._targets[begin:end].tolist()
+            )
+
+    def __contains__(self, pair) -> bool:
+        try:
+            source, target = pair
+        except (TypeError, ValueError):
+            return False
+
+        if self._sources.dtype == object:
+            if self._index is None:
+                self._index = set(self)
+            return (source, target) in self._index
+
+        if not isinstance(source, (int, np.integer)) or not isinstance(
+            target, (int, np.integer)
+        ):
+            return False
+        begin = np.searchsorted(self._sources, source, side="left")
+        end = np.searchsorted(self._sources, source, side="right")
+        position = begin + np.searchsorted(self._targets[begin:end], target)
+        return bool(position < end and self._targets[position] == target)
+
+    def to_set(self) -> set[tuple[Hashable, Hashable]]:
+        return set(self)
+
+    def to_numpy(self) -> np.ndarray:
+        return np.stack([self._sources, self._targets], axis=1)
+
+    def __repr__(self) -> str:
+        return f"NodePairs({len(self)} pairs)"
+
+
+def make_pairs(
+    sources: np.ndarray, targets: np.ndarray, columnar: bool
+) -> Union[set[tuple[Hashable, Hashable]], NodePairs]:
+    if columnar:
+        return NodePairs(sources, targets)
+    return set(zip(sources.tolist(), targets.tolist()))
@@ -0,0 +1,51 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List, Sequence, TypeVar
+
+from project.alphabet import ALPHABET
+
+Result = TypeVar("Result")
+
+# function and shared arguments of the pool, set once per worker process
+_worker_task = None
+
+
+def _init_worker(symbols, function: Callable, shared_args: tuple):
+    global _worker_task
+    # spawned workers start with an empty alphabet, ids must match the parent's
+    for symbol in symbols:
+        ALPHABET.intern(symbol)
+    _worker_task = (function, shared_args)
+
+
+def _run_chunk(chunk):
+    function, shared_args = _worker_task
+    return function(*shared_args, chunk)
+
+
+def split_chunks(items: Sequence, chunk_size: int) -> List[Sequence]:
+    chunk_size = max(chunk_size, 1)
+    return [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def map_chunks(
+    function: Callable[..., Result],
+    shared_args: tuple[Any, ...],
+    chunks: List[Sequence],
+    workers: int,
+) -> List[Result]:
+    # function(*shared_args, chunk) for every chunk; with fork the shared
+    # arguments are inherited by workers instead of being pickled per chunk
+    if workers <= 1 or len(chunks) <= 1:
+        return [function(*shared_args, chunk) for chunk in chunks]
+
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    )
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(chunks)),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(list(ALPHABET.symbols), function, shared_args),
+    ) as pool:
+        return list(pool.map(_run_chunk, chunks))
@@ -0,0 +1,129 @@
+import atexit
+import os
+import pickle
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, NamedTuple, Optional, TypeVar
+from pyformlang.finite_automaton import DeterministicFiniteAutomaton
+
+from project.task2 import regex_to_dfa
+
+Automaton = TypeVar("Automaton")
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _Entry:
+    def __init__(self, dfa: DeterministicFiniteAutomaton):
+        self.dfa = dfa
+        self.automata = dict()
+
+
+def normalize_regex(regex: str) -> str:
+    # pyformlang splits symbols on spaces only, other whitespace is part of
+    # a symbol and must be kept
+    return re.sub(" +", " ", regex).strip(" ")
+
+
+class RegexCache(Generic[Automaton]):
+    # least recently used minimized DFAs and their matrix forms, shared
+    # between queries, so callers must not modify what they get
+    _entries: OrderedDict[str, _Entry]
+
+    def __init__(
+        self,
+        build_automaton: Callable[[DeterministicFiniteAutomaton, type], Automaton],
+        maxsize: int = 256,
+        path: Optional[str] = None,
+    ):
+        self._build_automaton = build_automaton
+        self._maxsize = maxsize
+        self._path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._saved_at_exit = False
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def persist_to(self, path: str, save_at_exit: bool = True):
+        # warm restarts: DFAs saved at path are loaded now, and the cache is
+        # written back there when the interpreter exits
+        self._path = path
+        if os.path.exists(path):
+            self.load(path)
+        if save_at_exit and not self._saved_at_exit:
+            self._saved_at_exit = True
+            atexit.register(self.save)
+
+    def __entry(self, regex: str) -> _Entry:
+        key = normalize_regex(regex)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return entry
+            self._misses += 1
+
+        entry = _Entry(regex_to_dfa(key))
+        with self._lock:
+            entry = self._entries.setdefault(key, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def dfa(self, regex: str) -> DeterministicFiniteAutomaton:
+        return self.__entry(regex).dfa
+
+    def automaton(self, regex: str, matrix_type) -> Automaton:
+        entry = self.__entry(regex)
+        automaton = entry.automata.get(matrix_type)
+        if automaton is None:
+            automaton = entry.automata.setdefault(
+                matrix_type, self._build_automaton(entry.dfa, matrix_type)
+            )
+        return automaton
+
+    def stats(self) -> CacheStats:
+        return CacheStats(self._hits, self._misses, self._maxsize, len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+
+    # only DFAs are stored on disk: matrices are indexed by symbol ids of
+    # the process that built them
+    def save(self, path: Optional[str] = None):
+        path = path or self._path
+        if path is None:
+            raise ValueError("No path to save the regex cache to")
+        with self._lock:
+            dfas = [(key, entry.dfa) for key, entry in self._entries.items()]
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(dfas, file)
+        os.replace(temporary, path)
+
+    def load(self, path: Optional[str] = None):
+        path = path or self._path
+        if path is None:
+            raise ValueError("No path to load the regex cache from")
+        with open(path, "rb") as file:
+            dfas = pickle.load(file)
+        with self._lock:
+            for key, dfa in dfas:
+                if key not in self._entries:
+                    self._entries[key] = _Entry(dfa)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
@@ -1,42 +1,186 @@
 from collections import defaultdict
-from dataclasses import dataclass
-from itertools import product
-from typing import Iterable, List, Optional, Self, Generic, TypeVar, cast
+from collections.abc import Mapping, MutableMapping, Sequence
+from copy import copy
+from itertools import chain, product
+from typing import (
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Self,
+    Generic,
+    TypeVar,
+    Union,
+)
 from networkx import MultiDiGraph
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, State, Symbol
+import numpy as np
 import scipy.sparse as sp
 
-from project.task2 import regex_to_dfa, graph_to_nfa
+from project.alphabet import ALPHABET
+from project.matrix_backend import (
+    MatrixBackend,
+    ScipySparseBackend,
+    VisitedMatrix,
+    csr_rows_indices,
+    get_backend,
+)
+from project.pairs import NodePairs, make_pairs, node_array
+from project.parallel import map_chunks, split_chunks
+from project.regex_cache import RegexCache
 
 Matrix = TypeVar("Matrix")
 
+# tensor_based_rpq runs reachability from the start nodes only
+# when there are at most this share of the graph nodes among them
+SOURCE_RESTRICTED_RATIO = 0.25
+
+
+def _to_bool_csr(matrix) -> sp.csr_matrix:
+    matrix = sp.csr_matrix(matrix, dtype=bool, copy=True)
+    matrix.eliminate_zeros()
+    return matrix
+
+
+class _SymbolMatrices(MutableMapping):
+    # Symbol keyed view of the id indexed matrices; missing symbols get
+    # an empty matrix on access, as in defaultdict
+    def __init__(self, automaton: "AdjacencyMatrixFA"):
+        self._automaton = automaton
+
+    def __getitem__(self, symbol) -> Matrix:
+        symbol_id = ALPHABET.intern(symbol)
+        matrix = self._automaton.matrix(symbol_id)
+        if matrix is None:
+            matrix = self._automaton.empty_matrix()
+            self._automaton.set_matrix(symbol_id, matrix)
+        # the matrix may be modified in place, so its csr copy is stale
+        self._automaton._forget_csr(symbol_id)
+        return matrix
+
+    def __setitem__(self, symbol, matrix: Matrix):
+        self._automaton.set_matrix(ALPHABET.intern(symbol), matrix)
+
+    def __delitem__(self, symbol):
+        if symbol not in self:
+            raise KeyError(symbol)
+        self._automaton.set_matrix(ALPHABET.find(symbol), None)
+
+    def __contains__(self, symbol) -> bool:
+        symbol_id = ALPHABET.find(symbol)
+        return symbol_id is not None and self._automaton.matrix(symbol_id) is not None
+
+    def __iter__(self) -> Iterator[Symbol]:
+        return (ALPHABET.symbol(i) for i in self._automaton.symbol_ids())
+
+    def __len__(self) -> int:
+        return len(self._automaton.symbol_ids())
+
+
+class _ProductNumToState(Sequence):
+    def __init__(self, num_to_state1: Sequence[State], num_to_state2: Sequence[State]):
+        self._num_to_state1 = num_to_state1
+        self._num_to_state2 = num_to_state2
+
+    def __getitem__(self, num: int) -> State:
+        if num < 0:
+            num += len(self)
+        if not 0 <= num < len(self):
+            raise IndexError(num)
+        st1, st2 = divmod(num, len(self._num_to_state2))
+        return State((self._num_to_state1[st1], self._num_to_state2[st2]))
+
+    def __len__(self) -> int:
+        return len(self._num_to_state1) * len(self._num_to_state2)
+
+
+class _ProductStatesToNum(Mapping):
+    def __init__(
+        self, states_to_num1: Mapping[State, int], states_to_num2: Mapping[State, int]
+    ):
+        self._states_to_num1 = states_to_num1
+        self._states_to_num2 = states_to_num2
+
+    def __getitem__(self, state) -> int:
+        try:
+            st1, st2 = state.value if isinstance(state, State) else state
+        except (TypeError, ValueError):
+            raise KeyError(state)
+        return (
+            self._states_to_num1[st1] * len(self._states_to_num2)
+            + (self._states_to_num2[st2])
+        )
+
+    def __iter__(self) -> Iterator[State]:
+        return (
+            State((st1, st2))
+            for st1, st2 in product(self._states_to_num1, self._states_to_num2)
+        )
+
+    def __len__(self) -> int:
+        return len(self._states_to_num1) * len(self._states_to_num2)
+
 
 class AdjacencyMatrixFA(Generic[Matrix]):
     _matrix_type: Matrix
-    _adj_matrices: dict[Symbol, Matrix]
+    _matrices: List[Optional[Matrix]]
     _states_number: int
     _start_states: set[int]
     _final_states: set[int]
     _states_to_num: dict[State, int]
     _num_to_state: List[State]
+    _csr_cache: dict[int, tuple[Matrix, sp.csr_matrix]]
+    _state_values: Optional[np.ndarray]
 
     @staticmethod
     def __enumerate_value(value) -> dict[State, int]:
         return {val: idx for idx, val in enumerate(value)}
 
-    def __get_symbol_adj_matrix_dict(self, nfa) -> dict[Symbol, Matrix]:
-        symbol_state = defaultdict(
-            lambda: self._matrix_type((len(nfa.states), len(nfa.states)), dtype=bool)
-        )
+    def __get_symbol_matrices(self, nfa) -> List[Optional[Matrix]]:
+        symbol_to_id = {}
+        symbol_ids, rows, cols = [], [], []
         for start_state, value in nfa.to_dict().items():
+            start_state_int = self._states_to_num[start_state]
             for symbol, end_states in value.items():
-                start_state_int = self._states_to_num[start_state]
+                symbol_id = symbol_to_id.setdefault(symbol, len(symbol_to_id))
                 if type(end_states) is State:
                     end_states = {end_states}
                 for end_st in end_states:
-                    end_state_int = self._states_to_num[end_st]
-                    symbol_state[symbol][start_state_int, end_state_int] = True
-        return symbol_state
+                    symbol_ids.append(symbol_id)
+                    rows.append(start_state_int)
+                    cols.append(self._states_to_num[end_st])
+        return self.__symbol_matrices_from_arrays(
+            list(symbol_to_id), np.array(symbol_ids), np.array(rows), np.array(cols)
+        )
+
+    def __symbol_matrices_from_arrays(
+        self,
+        symbols: List[Symbol],
+        symbol_ids: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+    ) -> List[Optional[Matrix]]:
+        n = self._states_number
+        # all symbol matrices stacked vertically, so that COO to CSR
+        # conversion groups edges by symbol in linear time
+        stacked = sp.csr_matrix(
+            (
+                np.ones(len(rows), dtype=bool),
+                (
+                    symbol_ids.astype(np.int64) * n + rows.astype(np.int64),
+                    cols.astype(np.int64),
+                ),
+            ),
+            shape=(len(symbols) * n, n),
+        )
+        global_ids = [ALPHABET.intern(symbol) for symbol in symbols]
+        symbol_matrices = [None] * (max(global_ids, default=-1) + 1)
+        for symbol_id, global_id in enumerate(global_ids):
+            symbol_matrices[global_id] = self._matrix_type(
+                stacked[symbol_id * n : (symbol_id + 1) * n]
+            )
+        return symbol_matrices
 
     def __init__(
         self,
@@ -44,7 +188,9 @@ class AdjacencyMatrixFA(Generic[Matrix]):
         matrix_type: Matrix = sp.lil_matrix,
     ):
         self._matrix_type = matrix_type
-        self._adj_matrices = dict()
+        self._matrices = []
+        self._csr_cache = dict()
+        self._state_values = None
         if nfa is None:
             self._states_number = 0
             self._start_states = set()
@@ -59,40 +205,252 @@ class AdjacencyMatrixFA(Generic[Matrix]):
         self._start_states = set(self._states_to_num[i] for i in nfa.start_states)
         self._final_states = set(self._states_to_num[i] for i in nfa.final_states)
 
-        self._adj_matrices = self.__get_symbol_adj_matrix_dict(nfa)
-
-    def __dfs_find_path(self, word: Iterable[Symbol]):
-        @dataclass
-        class Configuration:
-            word: List[Symbol]
-            state: int
-
-        stack = [
-            Configuration(list(word), start_state) for start_state in self._start_states
-        ]
+        self._matrices = self.__get_symbol_matrices(nfa)
 
-        while len(stack):
-            cur_conf = stack.pop()
+    @classmethod
+    def from_edge_arrays(
+        cls,
+        states: List[State],
+        symbols: List[Symbol],
+        symbol_ids: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        start_states: Iterable[int],
+        final_states: Iterable[int],
+        matrix_type: Matrix = sp.csr_matrix,
+    ) -> Self:
+        instance = cls(None, matrix_type)
+        instance._num_to_state = states
+        instance._states_to_num = cls.__enumerate_value(states)
+        instance._states_number = len(states)
+        instance._start_states = set(start_states)
+        instance._final_states = set(final_states)
+        instance._matrices = instance.__symbol_matrices_from_arrays(
+            symbols, symbol_ids, rows, cols
+        )
+        return instance
 
-            if not len(cur_conf.word):
-                if cur_conf.state in self._final_states:
-                    return True
-                continue
+    @classmethod
+    def from_graph(
+        cls,
+        graph: MultiDiGraph,
+        start_nodes: set[int] = None,
+        final_nodes: set[int] = None,
+        matrix_type: Matrix = sp.csr_matrix,
+    ) -> Self:
+        return PreparedGraph(graph).automaton(start_nodes, final_nodes, matrix_type)
+
+    def with_states(
+        self, start_states: Iterable[int], final_states: Iterable[int]
+    ) -> Self:
+        # the copy shares symbol matrices, so they must be replaced, not modified
+        instance = copy(self)
+        instance._matrices = list(self._matrices)
+        instance._start_states = set(start_states)
+        instance._final_states = set(final_states)
+        return instance
 
-            next_symbol = cur_conf.word[0]
-            if next_symbol not in self._adj_matrices.keys():
-                continue
+    def symbol_ids(self) -> List[int]:
+        return [i for i, matrix in enumerate(self._matrices) if matrix is not None]
+
+    def matrix(self, symbol_id: int) -> Optional[Matrix]:
+        if 0 <= symbol_id < len(self._matrices):
+            return self._matrices[symbol_id]
+        return None
+
+    def set_matrix(self, symbol_id: int, matrix: Optional[Matrix]):
+        if symbol_id >= len(self._matrices):
+            self._matrices.extend([None] * (symbol_id + 1 - len(self._matrices)))
+        self._matrices[symbol_id] = matrix
+
+    def add_edges(self, symbol_id: int, rows: np.ndarray, cols: np.ndarray) -> int:
+        # merged with one sparse addition into a new matrix, so matrices
+        # shared with other automata are never modified; returns new edges
+        n = self._states_number
+        edges = sp.csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n)
+        )
+        matrix = self.matrix(symbol_id)
+        if matrix is not None:
+            matrix = _to_bool_csr(matrix)
+            added = (edges > matrix).count_nonzero()
+            if not added:
+                return 0
+            edges = edges + matrix
+        else:
+            added = edges.count_nonzero()
+        self.set_matrix(symbol_id, self._matrix_type(edges))
+        return added
+
+    def empty_matrix(self) -> Matrix:
+        return self._matrix_type((self._states_number, self._states_number), dtype=bool)
+
+    def _has_symbol(self, symbol_id: Optional[int]) -> bool:
+        return symbol_id is not None and self.matrix(symbol_id) is not None
+
+    def _forget_csr(self, symbol_id: int):
+        self._csr_cache.pop(symbol_id, None)
+
+    def __csr_matrix(self, symbol_id: int) -> sp.csr_matrix:
+        matrix = self._matrices[symbol_id]
+        if matrix.format == "csr" and matrix.dtype == bool:
+            return matrix
+
+        cached = self._csr_cache.get(symbol_id)
+        if cached is None or cached[0] is not matrix:
+            cached = (matrix, _to_bool_csr(matrix))
+            self._csr_cache[symbol_id] = cached
+        return cached[1]
+
+    def _symbol_step(self, front: sp.csr_matrix, symbol_id: int) -> sp.csr_matrix:
+        return front @ self.__csr_matrix(symbol_id)
+
+    def __start_front(self) -> sp.csr_matrix:
+        start_states = list(self._start_states)
+        return sp.csr_matrix(
+            (
+                np.ones(len(start_states), dtype=bool),
+                (np.zeros(len(start_states), dtype=np.int64), start_states),
+            ),
+            shape=(1, self._states_number),
+        )
 
-            for i in range(self._states_number):
-                if self._adj_matrices[next_symbol][cur_conf.state, i]:
-                    stack.append(Configuration(cur_conf.word[1:], i))
+    def __accepted_rows(self, fronts: sp.csr_matrix) -> np.ndarray:
+        return fronts[:, list(self._final_states)].getnnz(axis=1) > 0
 
-        return False
+    def _advance_states(self, states: np.ndarray, symbol_id: int) -> np.ndarray:
+        matrix = self.__csr_matrix(symbol_id)
+        if len(states) == 1:
+            return matrix.indices[
+                matrix.indptr[states[0]] : matrix.indptr[states[0] + 1]
+            ]
+        return np.unique(csr_rows_indices(matrix, states))
 
     def accepts(self, word: Iterable[Symbol]) -> bool:
-        return self.__dfs_find_path(word)
+        states = np.array(list(self._start_states), dtype=np.int64)
+
+        for symbol in word:
+            symbol_id = ALPHABET.find(symbol)
+            if not self._has_symbol(symbol_id) or not len(states):
+                return False
+            states = self._advance_states(states, symbol_id)
+
+        return any(state in self._final_states for state in states.tolist())
+
+    def accepts_batch(self, words: Iterable[Iterable[Symbol]]) -> List[bool]:
+        # words are put into a trie, so that common prefixes are simulated once
+        children: List[dict[int, int]] = [{}]
+        word_ends: List[List[int]] = [[]]
+        words_number = 0
+        for word in words:
+            node = 0
+            for symbol in word:
+                symbol_id = ALPHABET.find(symbol)
+                symbol_id = -1 if symbol_id is None else symbol_id
+                child = children[node].get(symbol_id)
+                if child is None:
+                    child = len(children)
+                    children[node][symbol_id] = child
+                    children.append({})
+                    word_ends.append([])
+                node = child
+            word_ends[node].append(words_number)
+            words_number += 1
+
+        result = [False] * words_number
+        nodes = [0]
+        fronts = self.__start_front()
+
+        while nodes:
+            for node, accepted in zip(nodes, self.__accepted_rows(fronts)):
+                if accepted:
+                    for word_index in word_ends[node]:
+                        result[word_index] = True
+
+            # trie nodes of the same depth are advanced by one product per symbol
+            symbol_rows = defaultdict(list)
+            for row, node in enumerate(nodes):
+                for symbol_id, child in children[node].items():
+                    symbol_rows[symbol_id].append((row, child))
+
+            next_nodes, next_fronts = [], []
+            for symbol_id, rows_children in symbol_rows.items():
+                if not self._has_symbol(symbol_id):
+                    continue
+                rows, symbol_children = zip(*rows_children)
+                stepped = self._symbol_step(fronts[list(rows)], symbol_id)
+                alive = np.diff(stepped.indptr) > 0
+                next_nodes.extend(np.array(symbol_children)[alive].tolist())
+                next_fronts.append(stepped[alive])
+
+            nodes = next_nodes
+            if nodes:
+                fronts = sp.vstack(next_fronts, format="csr")
+
+        return result
+
+    def accepts_many(self, words: Iterable[Iterable[Symbol]]) -> np.ndarray:
+        words = [word if isinstance(word, list) else list(word) for word in words]
+        lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        offsets = np.cumsum(lengths) - lengths
+
+        # every distinct symbol is looked up once; its code is the block of
+        # its matrix among the stacked ones, -1 for symbols not in automaton
+        codes = {
+            symbol: code for code, symbol in enumerate(set(chain.from_iterable(words)))
+        }
+        flat = np.fromiter(
+            map(codes.__getitem__, chain.from_iterable(words)),
+            dtype=np.int64,
+            count=int(lengths.sum()),
+        )
+        symbol_ids = [ALPHABET.find(symbol) for symbol in codes]
+        known_ids = [i for i in symbol_ids if self._has_symbol(i)]
+        block_of = {symbol_id: block for block, symbol_id in enumerate(known_ids)}
+        blocks = np.array(
+            [block_of.get(symbol_id, -1) for symbol_id in symbol_ids],
+            dtype=np.int64,
+        )[flat]
+
+        n = self._states_number
+        stacked = sp.vstack(
+            [self.__csr_matrix(symbol_id) for symbol_id in known_ids]
+            + [sp.csr_matrix((0, n), dtype=bool)],
+            format="csr",
+        )
+        deterministic = len(self._start_states) <= 1 and (
+            not stacked.nnz or np.diff(stacked.indptr).max() <= 1
+        )
+        is_final = np.zeros(n, dtype=bool)
+        is_final[list(self._final_states)] = True
+
+        # (word, state) pairs of all words advance together, one symbol a step
+        starts = np.array(list(self._start_states), dtype=np.int64)
+        pair_words = np.repeat(np.arange(len(words)), len(starts))
+        pair_states = np.tile(starts, len(words))
+        result = np.zeros(len(words), dtype=bool)
+        position = 0
+        while len(pair_words):
+            ended = lengths[pair_words] == position
+            result[pair_words[ended & is_final[pair_states]]] = True
+            pair_words, pair_states = pair_words[~ended], pair_states[~ended]
+
+            pair_blocks = blocks[offsets[pair_words] + position]
+            known = pair_blocks >= 0
+            pair_words, pair_states = pair_words[known], pair_states[known]
+            rows = pair_blocks[known] * n + pair_states
+            pair_words = np.repeat(
+                pair_words, stacked.indptr[rows + 1] - stacked.indptr[rows]
+            )
+            pair_states = csr_rows_indices(stacked, rows)
+            if not deterministic:
+                pairs = np.unique(pair_words * n + pair_states)
+                pair_words, pair_states = np.divmod(pairs, n)
+            position += 1
 
-    def __pow_closure(self, matrix):
+        return result
+
+    def __pow_closure(self, matrix, backend: MatrixBackend):
         cur = matrix
         power = 1
         for i in range(2, self._states_number + 1):
@@ -104,71 +462,132 @@ class AdjacencyMatrixFA(Generic[Matrix]):
             if prev.nnz == cur.nnz:
                 if (cur != prev).nnz == 0:
                     break
-        return cur
+        return backend.convert(cur)
 
-    def transitive_closure(self) -> Matrix:
-        if self._adj_matrices:
-            sum_matrix = cast(Matrix, sum(self._adj_matrices.values()))
+    @staticmethod
+    def __delta_closure(matrix, backend: MatrixBackend):
+        matrix = backend.convert(matrix)
+        closure = matrix
+        delta = matrix
+        while backend.nnz(delta):
+            delta = backend.difference(backend.multiply(delta, matrix), closure)
+            closure = backend.add(closure, delta)
+        return closure
+
+    @staticmethod
+    def __squaring_closure(matrix, backend: MatrixBackend):
+        closure = backend.convert(matrix)
+        while True:
+            squared = backend.multiply(closure, closure)
+            # diagonal is set, so closure is a subset of squared
+            if backend.nnz(squared) == backend.nnz(closure):
+                return closure
+            closure = squared
+
+    def transitive_closure(
+        self, method: str = "pow", backend: Union[str, MatrixBackend, None] = None
+    ):
+        closures = {
+            "pow": self.__pow_closure,
+            "delta": self.__delta_closure,
+            "squaring": self.__squaring_closure,
+        }
+        if method not in closures:
+            raise ValueError(f"Unknown closure method: {method}")
+        backend = get_backend(backend)
+
+        symbol_ids = self.symbol_ids()
+        if symbol_ids:
+            sum_matrix = sum(self._matrices[i] for i in symbol_ids)
             sum_matrix.setdiag(True)
-            res = self.__pow_closure(sum_matrix)
+            res = closures[method](sum_matrix, backend)
             return res
         else:
-            return sp.identity(self._states_number)
+            return backend.convert(sp.identity(self._states_number, dtype=bool))
 
-    def is_empty(self) -> bool:
-        if not self._adj_matrices:
-            return True
-        transitive_closure_matrix = self.transitive_closure()
+    def _propagator(self, backend: MatrixBackend):
+        step_matrix = sp.csr_matrix(
+            (self._states_number, self._states_number), dtype=bool
+        )
+        for symbol_id in self.symbol_ids():
+            step_matrix = step_matrix + _to_bool_csr(self._matrices[symbol_id])
+        step_matrix = backend.convert(step_matrix)
+
+        return lambda front: backend.multiply(front, step_matrix)
 
-        return not any(
-            transitive_closure_matrix[s, e]
-            for s, e in product(self._start_states, self._final_states)
+    def reachable_from(
+        self, states: Iterable[int], backend: Union[str, MatrixBackend, None] = None
+    ):
+        backend = get_backend(backend)
+        states = np.array(list(states), dtype=np.int64)
+        front = backend.build(
+            (len(states), self._states_number), np.arange(len(states)), states
         )
+        visited = VisitedMatrix(backend, front)
+        propagate = self._propagator(backend)
+
+        while backend.nnz(front):
+            front = visited.update(propagate(front))
+
+        return visited.matrix()
+
+    def is_empty(self) -> bool:
+        is_final = np.zeros(self._states_number, dtype=bool)
+        is_final[list(self._final_states)] = True
+        visited = np.zeros(self._states_number, dtype=bool)
+        front = np.array(list(self._start_states), dtype=np.int64)
+        visited[front] = True
+        symbol_ids = self.symbol_ids()
+
+        while len(front):
+            if is_final[front].any():
+                return False
+            reached = np.concatenate(
+                [self._advance_states(front, symbol_id) for symbol_id in symbol_ids]
+                + [np.empty(0, dtype=np.int64)]
+            )
+            front = np.unique(reached[~visited[reached]])
+            visited[front] = True
+
+        return True
 
     @classmethod
     def from_intersect(
         cls, automaton1: Self, automaton2: Self, matrix_type: Matrix = sp.lil_matrix
     ):
         instance = cls(None, matrix_type)
-        united_syms = [
-            sym
-            for sym in set(automaton1._adj_matrices.keys()).intersection(
-                automaton2._adj_matrices.keys()
-            )
+        instance._matrices = [
+            None
+            if matrix1 is None or matrix2 is None
+            else instance._matrix_type(sp.kron(matrix1, matrix2, format="coo"))
+            for matrix1, matrix2 in zip(automaton1._matrices, automaton2._matrices)
         ]
 
-        instance._adj_matrices = {
-            sym: instance._matrix_type(
-                sp.kron(automaton1._adj_matrices[sym], automaton2._adj_matrices[sym])
-            )
-            for sym in united_syms
-        }
+        instance._init_product_states(automaton1, automaton2)
+        return instance
 
+    def _init_product_states(self, automaton1: Self, automaton2: Self):
         def state_to_num(st1, st2):
             return st1 * automaton2._states_number + st2
 
         def intersect_states(states1, states2):
             return set(state_to_num(st1, st2) for st1, st2 in product(states1, states2))
 
-        instance._states_to_num = {
-            State((st1[0], st2[0])): state_to_num(st1[1], st2[1])
-            for st1, st2 in product(
-                automaton1._states_to_num.items(), automaton2._states_to_num.items()
-            )
-        }
-        instance._num_to_state = [
-            State(el)
-            for el in product(automaton1._num_to_state, automaton2._num_to_state)
-        ]
+        # product states are decoded from their numbers only when asked for
+        self._states_to_num = _ProductStatesToNum(
+            automaton1._states_to_num, automaton2._states_to_num
+        )
+        self._num_to_state = _ProductNumToState(
+            automaton1._num_to_state, automaton2._num_to_state
+        )
 
-        instance._start_states = intersect_states(
+        self._start_states = intersect_states(
             automaton1._start_states, automaton2._start_states
         )
-        instance._final_states = intersect_states(
+        self._final_states = intersect_states(
             automaton1._final_states, automaton2._final_states
         )
-        instance._states_number = automaton1._states_number * automaton2._states_number
-        return instance
+        self._states_number = automaton1._states_number * automaton2._states_number
 
     @property
     def states_number(self):
@@ -187,13 +606,221 @@ class AdjacencyMatrixFA(Generic[Matrix]):
         return self._states_to_num
 
     @property
-    def adj_matrices(self):
-        return self._adj_matrices
+    def adj_matrices(self) -> MutableMapping[Symbol, Matrix]:
+        return _SymbolMatrices(self)
 
     @property
     def num_to_state(self):
         return self._num_to_state
 
+    def state_values(self) -> np.ndarray:
+        # values of states by their numbers, for vectorized number decoding;
+        # built once and shared with copies, so it must not be modified
+        if self._state_values is None:
+            self._state_values = node_array(
+                [state.value for state in self._num_to_state]
+            )
+        return self._state_values
+
+
+class PreparedGraph:
+    # node index and edges grouped by label, built once for many queries
+    # with different start and final nodes
+    _graph: MultiDiGraph
+    _nodes: List[Hashable]
+    _node_to_num: dict[Hashable, int]
+    _labels: List[Hashable]
+    _label_ids: np.ndarray
+    _rows: np.ndarray
+    _cols: np.ndarray
+    _label_slices: dict[Hashable, slice]
+    _automata: dict[type, AdjacencyMatrixFA]
+
+    def __init__(self, graph: MultiDiGraph):
+        self._graph = graph
+        self._nodes = list(graph.nodes)
+        self._node_to_num = {node: idx for idx, node in enumerate(self._nodes)}
+
+        label_to_id = {}
+        label_ids, rows, cols = [], [], []
+        for u, v, label in graph.edges(data="label"):
+            if label is not None:
+                label_ids.append(label_to_id.setdefault(label, len(label_to_id)))
+                rows.append(self._node_to_num[u])
+                cols.append(self._node_to_num[v])
+
+        order = np.argsort(np.array(label_ids, dtype=np.int64), kind="stable")
+        self._labels = list(label_to_id)
+        self._label_ids = np.array(label_ids, dtype=np.int64)[order]
+        self._rows = np.array(rows, dtype=np.int64)[order]
+        self._cols = np.array(cols, dtype=np.int64)[order]
+        bounds = np.searchsorted(self._label_ids, np.arange(len(self._labels) + 1))
+        self._label_slices = {
+            label: slice(bounds[idx], bounds[idx + 1])
+            for idx, label in enumerate(self._labels)
+        }
+        self._automata = dict()
+
+    @property
+    def graph(self) -> MultiDiGraph:
+        return self._graph
+
+    @property
+    def nodes(self) -> List[Hashable]:
+        return self._nodes
+
+    @property
+    def labels(self) -> List[Hashable]:
+        return self._labels
+
+    @property
+    def node_to_num(self) -> Mapping[Hashable, int]:
+        return self._node_to_num
+
+    def number_of_nodes(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, node) -> bool:
+        return node in self._node_to_num
+
+    def label_edges(self, label) -> tuple[np.ndarray, np.ndarray]:
+        edges = self._label_slices.get(label, slice(0, 0))
+        return self._rows[edges], self._cols[edges]
+
+    def __node_numbers(self, nodes: Optional[Iterable[Hashable]]) -> Iterable[int]:
+        # nodes missing from the graph are skipped
+        if not nodes:
+            return range(len(self._nodes))
+        return (self._node_to_num[node] for node in nodes if node in self._node_to_num)
+
+    def automaton(
+        self,
+        start_nodes: Optional[set[int]] = None,
+        final_nodes: Optional[set[int]] = None,
+        matrix_type=sp.csr_matrix,
+    ) -> AdjacencyMatrixFA:
+        # symbol matrices are built once per matrix type and shared
+        automaton = self._automata.get(matrix_type)
+        if automaton is None:
+            automaton = AdjacencyMatrixFA.from_edge_arrays(
+                [State(node) for node in self._nodes],
+                [Symbol(label) for label in self._labels],
+                self._label_ids,
+                self._rows,
+                self._cols,
+                (),
+                (),
+                matrix_type,
+            )
+            # built before copying, so that every query shares one node array
+            automaton.state_values()
+            self._automata[matrix_type] = automaton
+        return automaton.with_states(
+            self.__node_numbers(start_nodes), self.__node_numbers(final_nodes)
+        )
+
+
+def prepare_graph(graph: Union[MultiDiGraph, PreparedGraph]) -> PreparedGraph:
+    if isinstance(graph, PreparedGraph):
+        return graph
+    return PreparedGraph(graph)
+
+
+# Intersection that never builds the Kronecker product: a front row reshaped
+# to |A states| x |B states| matrix X is propagated as Aᵀ X B
+class LazyIntersectionFA(AdjacencyMatrixFA[sp.csr_matrix]):
+    _factors: tuple[AdjacencyMatrixFA, AdjacencyMatrixFA]
+    _factor_matrices: List[Optional[tuple[sp.csr_matrix, sp.csr_matrix]]]
+
+    def __init__(self, automaton1: AdjacencyMatrixFA, automaton2: AdjacencyMatrixFA):
+        super().__init__(None, sp.csr_matrix)
+        self._factors = (automaton1, automaton2)
+        self._factor_matrices = [
+            None
+            if matrix1 is None or matrix2 is None
+            else (_to_bool_csr(matrix1.transpose()), _to_bool_csr(matrix2))
+            for matrix1, matrix2 in zip(automaton1._matrices, automaton2._matrices)
+        ]
+        self._init_product_states(automaton1, automaton2)
+
+    def symbol_ids(self) -> List[int]:
+        return [i for i, pair in enumerate(self._factor_matrices) if pair is not None]
+
+    def matrix(self, symbol_id: int) -> Optional[sp.csr_matrix]:
+        if self._has_symbol(symbol_id):
+            left_t, right = self._factor_matrices[symbol_id]
+            return sp.kron(left_t.transpose(), right, format="csr")
+        return None
+
+    def set_matrix(self, symbol_id: int, matrix: Optional[sp.csr_matrix]):
+        raise TypeError("LazyIntersectionFA matrices are defined by its factors")
+
+    def _symbol_step(self, front: sp.csr_matrix, symbol_id: int) -> sp.csr_matrix:
+        left_t, right = self._factor_matrices[symbol_id]
+        n1, n2 = left_t.shape[0], right.shape[0]
+        fronts_number = front.shape[0]
+
+        def pairs_to_matrix(rows, cols, shape):
+            return sp.csr_matrix(
+                (np.ones(len(rows), dtype=bool), (rows, cols)), shape=shape
+            )
+
+        # every front row becomes an n1 x n2 block: X_s B
+        coo = front.tocoo()
+        rows, cols = coo.row.astype(np.int64), coo.col.astype(np.int64)
+        x = pairs_to_matrix(rows * n1 + cols // n2, cols % n2, (fronts_number * n1, n2))
+        xb = (x @ right).tocoo()
+
+        # blocks side by side: Aᵀ [X_1 B | X_2 B | ...]
+        rows, cols = xb.row.astype(np.int64), xb.col.astype(np.int64)
+        xb = pairs_to_matrix(
+            rows % n1, rows // n1 * n2 + cols, (n1, fronts_number * n2)
+        )
+        axb = (left_t @ xb).tocoo()
+
+        rows, cols = axb.row.astype(np.int64), axb.col.astype(np.int64)
+        return pairs_to_matrix(
+            cols // n2, rows * n2 + cols % n2, (fronts_number, n1 * n2)
+        )
+
+    def _has_symbol(self, symbol_id: Optional[int]) -> bool:
+        return (
+            symbol_id is not None
+            and 0 <= symbol_id < len(self._factor_matrices)
+            and self._factor_matrices[symbol_id] is not None
+        )
+
+    def _advance_states(self, states: np.ndarray, symbol_id: int) -> np.ndarray:
+        front = sp.csr_matrix(
+            (np.ones(len(states), dtype=bool), (np.zeros_like(states), states)),
+            shape=(1, self._states_number),
+        )
+        return self._symbol_step(front, symbol_id).indices
+
+    def accepts_many(self, words: Iterable[Iterable[Symbol]]) -> np.ndarray:
+        # product matrices can not be stacked, words are stepped lazily instead
+        return np.array(self.accepts_batch(words), dtype=bool)
+
+    def _propagator(self, backend: MatrixBackend):
+        if not isinstance(backend, ScipySparseBackend):
+            raise ValueError("LazyIntersectionFA propagates fronts as scipy matrices")
+        symbol_ids = self.symbol_ids()
+
+        def propagate(front):
+            result = sp.csr_matrix(front.shape, dtype=bool)
+            for symbol_id in symbol_ids:
+                result = result + self._symbol_step(front, symbol_id)
+            return result
+
+        return propagate
+
+    def transitive_closure(
+        self, method: str = "delta", backend: Union[str, MatrixBackend, None] = None
+    ):
+        if method != "delta":
+            raise ValueError(f"Closure method {method} needs product matrices")
+        return self.reachable_from(range(self._states_number), backend)
+
 
 def intersect_automata(
     automaton1: AdjacencyMatrixFA, automaton2: AdjacencyMatrixFA
@@ -201,28 +828,126 @@ def intersect_automata(
     return AdjacencyMatrixFA.from_intersect(automaton1, automaton2)
 
 
+def __states_mask(states_number: int, states: Iterable[int]) -> np.ndarray:
+    mask = np.zeros(states_number, dtype=bool)
+    mask[list(states)] = True
+    return mask
+
+
+def __to_node_pairs(
+    adj_graph: AdjacencyMatrixFA,
+    regex_states_number: int,
+    starts: np.ndarray,
+    finals: np.ndarray,
+    columnar: bool,
+) -> Union[set[tuple[int, int]], NodePairs]:
+    # graph state of a product state is its number divided by regex states number
+    nodes = adj_graph.state_values()
+    return make_pairs(
+        nodes[starts // regex_states_number],
+        nodes[finals // regex_states_number],
+        columnar,
+    )
+
+
+def __reachable_finals(
+    adj_intersect: AdjacencyMatrixFA,
+    backend: MatrixBackend,
+    is_final: np.ndarray,
+    start_states: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    reachable = adj_intersect.reachable_from(start_states, backend)
+    rows, cols = backend.extract_pairs(reachable)
+    final_mask = is_final[cols]
+    return start_states[rows[final_mask]], cols[final_mask]
+
+
+def __source_restricted_rpq(
+    adj_intersect: AdjacencyMatrixFA,
+    adj_graph: AdjacencyMatrixFA,
+    regex_states_number: int,
+    backend: MatrixBackend,
+    workers: int,
+    columnar: bool,
+) -> Union[set[tuple[int, int]], NodePairs]:
+    start_states = np.array(list(adj_intersect.start_states), dtype=np.int64)
+    is_final = __states_mask(adj_intersect.states_number, adj_intersect.final_states)
+
+    results = map_chunks(
+        __reachable_finals,
+        (adj_intersect, backend, is_final),
+        split_chunks(start_states, -(-len(start_states) // workers)),
+        workers,
+    )
+    empty = np.empty(0, dtype=np.int64)
+
+    return __to_node_pairs(
+        adj_graph,
+        regex_states_number,
+        np.concatenate([starts for starts, _ in results] + [empty]),
+        np.concatenate([finals for _, finals in results] + [empty]),
+        columnar,
+    )
+
+
+# minimized regex DFAs and their adjacency matrices, reused between queries;
+# REGEX_CACHE.persist_to(path) keeps the DFAs between runs
+REGEX_CACHE = RegexCache(AdjacencyMatrixFA)
+
+
 def tensor_based_rpq(
     regex: str,
-    graph: MultiDiGraph,
-    start_nodes: set[int],
-    final_nodes: set[int],
+    graph: Union[MultiDiGraph, PreparedGraph],
+    start_nodes: Optional[set[int]],
+    final_nodes: Optional[set[int]],
     matrix_type=sp.lil_matrix,
-) -> set[tuple[int, int]]:
-    regex_dfa = regex_to_dfa(regex)
-    adj_regex = AdjacencyMatrixFA(regex_dfa, matrix_type)
-    graph_nfa = graph_to_nfa(graph, start_nodes, final_nodes)
-    adj_graph = AdjacencyMatrixFA(graph_nfa, matrix_type)
-    adj_intersect = AdjacencyMatrixFA.from_intersect(adj_graph, adj_regex, matrix_type)
-
-    adj_closure = adj_intersect.transitive_closure()
+    closure_method: Optional[str] = None,
+    lazy: bool = False,
+    backend: Union[str, MatrixBackend, None] = None,
+    workers: int = 1,
+    columnar: bool = False,
+) -> Union[set[tuple[int, int]], NodePairs]:
+    # matrix_type is how the automata are stored, backend is what closures run on
+    backend = get_backend(backend)
+    adj_regex = REGEX_CACHE.automaton(regex, matrix_type)
+    # no start or final nodes mean all of them
+    adj_graph = prepare_graph(graph).automaton(start_nodes, final_nodes, matrix_type)
+    if closure_method is None:
+        closure_method = (
+            "sources"
+            if workers > 1
+            or len(adj_graph.start_states)
+            <= SOURCE_RESTRICTED_RATIO * adj_graph.states_number
+            else "delta"
+        )
+    if workers > 1 and closure_method != "sources":
+        raise ValueError("Only the sources closure method runs in worker processes")
+
+    if lazy:
+        adj_intersect = LazyIntersectionFA(adj_graph, adj_regex)
+    else:
+        adj_intersect = AdjacencyMatrixFA.from_intersect(
+            adj_graph, adj_regex, matrix_type
+        )
 
-    result = {
-        (
-            adj_intersect.num_to_state[start].value[0],
-            adj_intersect.num_to_state[final].value[0],
+    if closure_method == "sources":
+        return __source_restricted_rpq(
+            adj_intersect,
+            adj_graph,
+            adj_regex.states_number,
+            backend,
+            workers,
+            columnar,
         )
-        for start, final in zip(*adj_closure.nonzero())
-        if start in adj_intersect.start_states and final in adj_intersect.final_states
-    }
 
-    return result
+    adj_closure = adj_intersect.transitive_closure(closure_method, backend)
+
+    starts, finals = backend.extract_pairs(adj_closure)
+    mask = (
+        __states_mask(adj_intersect.states_number, adj_intersect.start_states)[starts]
+        & __states_mask(adj_intersect.states_number, adj_intersect.final_states)[finals]
+    )
+
+    return __to_node_pairs(
+        adj_graph, adj_regex.states_number, starts[mask], finals[mask], columnar
+    )
@@ -1,117 +1,389 @@
-from copy import copy
 from functools import reduce
-from typing import Generic, TypeVar
+from typing import Generic, Iterable, Iterator, Optional, TypeVar, Union
 from networkx import MultiDiGraph
-from pyformlang.finite_automaton import Symbol
+import numpy as np
 import scipy.sparse as sp
 
-from project.task2 import regex_to_dfa, graph_to_nfa
-from project.task3 import AdjacencyMatrixFA
+from project.matrix_backend import (
+    BACKENDS,
+    DENSE_VISITED_RATIO,
+    MatrixBackend,
+    VisitedMatrix,
+    csr_rows_indices,
+    get_backend,
+)
+from project.pairs import NodePairs, make_pairs
+from project.parallel import map_chunks, split_chunks
+from project.task3 import (
+    REGEX_CACHE,
+    AdjacencyMatrixFA,
+    PreparedGraph,
+    prepare_graph,
+)
 
 Matrix = TypeVar("Matrix")
 
+# Beamer's direction switching: pull once edges out of the front exceed the
+# edges into unvisited entries divided by alpha, push again once the front
+# holds less than all entries divided by beta
+PULL_ALPHA = 14
+PUSH_BETA = 24
+
 
 class MsBfsRpq(Generic[Matrix]):
-    __matrix_type: Matrix
+    __backend: MatrixBackend
     __adj_dfa: AdjacencyMatrixFA
     __adj_nfa: AdjacencyMatrixFA
     __shift: int
-    __united_symbols: set[Symbol]
+    __united_symbols: list[int]
+    __front_update: str
+    __dense_visited_ratio: float
+    __direction: str
+    __start_states: np.ndarray
+    __is_dfa_final: np.ndarray
+    __is_nfa_final: np.ndarray
+    __node_values: np.ndarray
 
     def __init__(
         self,
         adj_dfa: AdjacencyMatrixFA,
         adj_nfa: AdjacencyMatrixFA,
         matrix_type=sp.csr_matrix,
+        backend: Union[str, MatrixBackend, None] = None,
+        front_update: str = "gather",
+        start_states: Optional[Iterable[int]] = None,
+        dense_visited_ratio: float = DENSE_VISITED_RATIO,
+        direction: str = "push",
     ):
-        self.__matrix_type = matrix_type
+        self.__backend = get_backend(backend, matrix_type)
+        self.__dense_visited_ratio = dense_visited_ratio
         self.__adj_dfa = adj_dfa
         self.__adj_nfa = adj_nfa
-        self.__start_states_list = list(adj_nfa.start_states)
-        self.__shift = self.__adj_dfa.states_number
-        self.__united_symbols = set(self.__adj_dfa.adj_matrices.keys()).intersection(
-            self.__adj_nfa.adj_matrices.keys()
+        self.__start_states_list = list(
+            adj_nfa.start_states if start_states is None else start_states
         )
-        self.__permutation_matrices = {
-            symbol: sp.block_diag(
-                [
-                    adj_dfa.adj_matrices[symbol].transpose()
-                    for _ in self.__start_states_list
-                ]
+        self.__shift = self.__adj_dfa.states_number
+        # answers of every level are decoded with these
+        self.__start_states = np.array(self.__start_states_list, dtype=np.int64)
+        self.__is_dfa_final = np.zeros(self.__shift, dtype=bool)
+        self.__is_dfa_final[list(adj_dfa.final_states)] = True
+        self.__is_nfa_final = np.zeros(adj_nfa.states_number, dtype=bool)
+        self.__is_nfa_final[list(adj_nfa.final_states)] = True
+        self.__node_values = adj_nfa.state_values()
+        self.__united_symbols = [
+            symbol_id
+            for symbol_id in adj_dfa.symbol_ids()
+            if adj_nfa.matrix(symbol_id) is not None
+        ]
+        if front_update not in ("gather", "block_diag"):
+            raise ValueError(f"Unknown front update: {front_update}")
+        self.__front_update = front_update
+        self.__symbol_matrices = [
+            (
+                self.__backend.convert(adj_nfa.matrix(symbol_id)),
+                self.__dfa_step_matrix(adj_dfa.matrix(symbol_id)),
             )
-            for symbol in self.__united_symbols
-        }
+            for symbol_id in self.__united_symbols
+        ]
+
+        if direction not in ("push", "pull", "auto"):
+            raise ValueError(f"Unknown BFS direction: {direction}")
+        self.__direction = direction
+        # built on first use, a run that never pulls does not need them
+        self.__pull_matrices = None
+        self.__degrees = None
+
+    def __dfa_step_matrix(self, dfa_matrix):
+        if self.__front_update == "gather":
+            # front rows are start_index * shift + dfa_state, so the DFA step
+            # moves rows inside every block of shift rows
+            return BACKENDS["csr"].convert(dfa_matrix)
+        return self.__backend.convert(
+            sp.block_diag([dfa_matrix.transpose() for _ in self.__start_states_list])
+        )
 
     def __update_front(self, front_right: Matrix) -> Matrix:
-        def front_mul_matrix(cur_front, symbol) -> Matrix:
-            mul = cur_front @ self.__adj_nfa.adj_matrices[symbol]
-            return self.__permutation_matrices[symbol] @ mul
+        backend = self.__backend
+
+        def front_mul_matrix(cur_front, matrices) -> Matrix:
+            nfa_matrix, dfa_step_matrix = matrices
+            if self.__front_update == "gather":
+                return backend.map_rows(
+                    backend.multiply(cur_front, nfa_matrix), dfa_step_matrix
+                )
+            return backend.multiply(
+                dfa_step_matrix, backend.multiply(cur_front, nfa_matrix)
+            )
 
         updated_front = reduce(
-            lambda vector, matrix: vector + front_mul_matrix(front_right, matrix),
-            self.__united_symbols,
-            self.__matrix_type(front_right.shape, dtype=bool),
+            lambda vector, matrices: backend.add(
+                vector, front_mul_matrix(front_right, matrices)
+            ),
+            self.__symbol_matrices,
+            backend.empty(front_right.shape),
         )
 
         return updated_front
 
     def __get_init_front(self) -> Matrix:
-        vectors = []
-        for nfa_state_num in range(len(self.__adj_nfa.start_states)):
-            right_vector = self.__matrix_type(
-                (self.__shift, self.__adj_nfa.states_number), dtype=bool
-            )
-            for i in self.__adj_dfa.start_states:
-                right_vector[i, self.__start_states_list[nfa_state_num]] = True
-
-            vectors.append(right_vector)
-
-        return sp.vstack(vectors)
-
-    def __visited_to_result(self, visited: Matrix):
-        result = set()
-        for left, nfa_state in zip(*visited.nonzero()):
-            if (
-                left % self.__shift in self.__adj_dfa.final_states
-                and nfa_state in self.__adj_nfa.final_states
-            ):
-                result.add(
-                    (
-                        self.__adj_nfa.num_to_state[
-                            self.__start_states_list[left // self.__shift]
-                        ],
-                        self.__adj_nfa.num_to_state[nfa_state],
-                    )
+        # row start_index * shift + dfa_state, column nfa_state
+        dfa_starts = list(self.__adj_dfa.start_states)
+        rows, cols = [], []
+        for start_index, nfa_state in enumerate(self.__start_states_list):
+            for dfa_state in dfa_starts:
+                rows.append(start_index * self.__shift + dfa_state)
+                cols.append(nfa_state)
+
+        return self.__backend.build(
+            (
+                len(self.__start_states_list) * self.__shift,
+                self.__adj_nfa.states_number,
+            ),
+            np.array(rows, dtype=np.int64),
+            np.array(cols, dtype=np.int64),
+        )
+
+    def __answer_pairs(self, rows: np.ndarray, nfa_states: np.ndarray) -> np.ndarray:
+        start_indices, dfa_states = np.divmod(rows, self.__shift)
+        final_mask = self.__is_dfa_final[dfa_states] & self.__is_nfa_final[nfa_states]
+        # several final DFA states may reach the same node from one start
+        pairs = np.unique(
+            np.stack(
+                [
+                    self.__start_states[start_indices[final_mask]],
+                    nfa_states[final_mask],
+                ],
+                axis=1,
+            ),
+            axis=0,
+        )
+        return self.__node_values[pairs]
+
+    def __visited_to_result(self, visited: VisitedMatrix) -> np.ndarray:
+        return self.__answer_pairs(*visited.extract_pairs())
+
+    def __get_pull_matrices(self) -> list[tuple[sp.csr_matrix, sp.csr_matrix]]:
+        if self.__pull_matrices is None:
+            # predecessors of a graph node are the row of the transposed matrix
+            self.__pull_matrices = [
+                (
+                    BACKENDS["csr"].convert(
+                        self.__adj_nfa.matrix(symbol_id).transpose()
+                    ),
+                    BACKENDS["csr"].convert(self.__adj_dfa.matrix(symbol_id)),
                 )
-        return result
+                for symbol_id in self.__united_symbols
+            ]
+        return self.__pull_matrices
+
+    def __get_degrees(self) -> tuple[np.ndarray, np.ndarray]:
+        # in and out degrees of graph nodes over the labels of the query
+        if self.__degrees is None:
+            states_number = self.__adj_nfa.states_number
+            in_degrees = np.zeros(states_number, dtype=np.int64)
+            out_degrees = np.zeros(states_number, dtype=np.int64)
+            for symbol_id in self.__united_symbols:
+                nfa_matrix = sp.csr_matrix(self.__adj_nfa.matrix(symbol_id))
+                out_degrees += np.diff(nfa_matrix.indptr)
+                in_degrees += np.bincount(nfa_matrix.indices, minlength=states_number)
+            self.__degrees = (in_degrees, out_degrees)
+        return self.__degrees
+
+    def __pull_front(self, front_right: Matrix, visited: VisitedMatrix) -> Matrix:
+        # unvisited entries check their graph predecessors against the front
+        bit_packed = BACKENDS["bitpacked"]
+        rows, cols = visited.unvisited_pairs()
+        front_bits = bit_packed.convert(front_right)
+        found = np.zeros(len(rows), dtype=bool)
+
+        for nfa_transposed, dfa_matrix in self.__get_pull_matrices():
+            stepped = bit_packed.map_rows(front_bits, dfa_matrix)
+            candidates = np.flatnonzero(~found)
+            candidate_cols = cols[candidates]
+            lengths = np.diff(nfa_transposed.indptr)[candidate_cols]
+            hits = stepped.get(
+                np.repeat(rows[candidates], lengths),
+                csr_rows_indices(nfa_transposed, candidate_cols),
+            )
+            found[np.repeat(candidates, lengths)[hits]] = True
+
+        return self.__backend.build(front_right.shape, rows[found], cols[found])
+
+    def __fronts(self, front_right: Matrix, visited: VisitedMatrix) -> Iterator[Matrix]:
+        # yields every front, already marked as visited, before advancing it
+        backend = self.__backend
+        pulling = self.__direction == "pull"
+        if self.__direction == "auto":
+            in_degrees, out_degrees = self.__get_degrees()
+            entries_number = front_right.shape[0] * front_right.shape[1]
+            unvisited_edges = front_right.shape[0] * int(in_degrees.sum())
+
+        while backend.nnz(front_right):
+            yield front_right
+            if self.__direction == "auto":
+                _, front_cols = backend.extract_pairs(front_right)
+                unvisited_edges -= int(in_degrees[front_cols].sum())
+                if pulling:
+                    pulling = len(front_cols) >= entries_number / PUSH_BETA
+                else:
+                    front_edges = int(out_degrees[front_cols].sum())
+                    pulling = front_edges > unvisited_edges / PULL_ALPHA
+
+            if pulling:
+                front_right = self.__pull_front(front_right, visited)
+            else:
+                front_right = self.__update_front(front_right)
+            front_right = visited.update(front_right)
 
     def __ms_bfs(self):
         front_right = self.__get_init_front()
-        visited = copy(front_right)
-
-        while front_right.count_nonzero():
-            front_right = self.__update_front(front_right)
-            front_right = front_right > visited
-            visited += front_right
+        visited = VisitedMatrix(self.__backend, front_right, self.__dense_visited_ratio)
+        for _ in self.__fronts(front_right, visited):
+            pass
 
         return self.__visited_to_result(visited)
 
-    def __call__(self) -> set[tuple[int, int]]:
-        return self.__ms_bfs()
+    def levels(self) -> Iterator[np.ndarray]:
+        # (start, node) answer pairs by BFS level, each pair once, so the
+        # search stops wherever the caller stops iterating
+        front_right = self.__get_init_front()
+        visited = VisitedMatrix(self.__backend, front_right, self.__dense_visited_ratio)
+        found = set()
+        for front_right in self.__fronts(front_right, visited):
+            pairs = self.__answer_pairs(*self.__backend.extract_pairs(front_right))
+            fresh = []
+            for index, pair in enumerate(map(tuple, pairs.tolist())):
+                if pair not in found:
+                    found.add(pair)
+                    fresh.append(index)
+            yield pairs[fresh]
+
+    def __call__(self, as_array: bool = False, columnar: bool = False):
+        pairs = self.__ms_bfs()
+        if as_array:
+            return pairs
+        return make_pairs(pairs[:, 0], pairs[:, 1], columnar)
+
+
+# front, visited and one product in flight, all dense in the worst case
+FRONT_MATRICES_IN_MEMORY = 3
+
+
+def __budget_chunk_size(
+    memory_budget: int,
+    adj_dfa: AdjacencyMatrixFA,
+    adj_nfa: AdjacencyMatrixFA,
+    backend: MatrixBackend,
+) -> int:
+    start_bytes = (
+        FRONT_MATRICES_IN_MEMORY
+        * adj_dfa.states_number
+        * adj_nfa.states_number
+        * backend.entry_bytes
+    )
+    return int(memory_budget // max(start_bytes, 1))
+
+
+def __ms_bfs_chunk(adj_dfa, adj_nfa, options: dict, start_states) -> np.ndarray:
+    return MsBfsRpq(adj_dfa, adj_nfa, start_states=start_states, **options)(
+        as_array=True
+    )
 
 
 def ms_bfs_based_rpq(
     regex: str,
-    graph: MultiDiGraph,
+    graph: Union[MultiDiGraph, PreparedGraph],
     start_nodes: set[int],
     final_nodes: set[int],
     matrix_type=sp.csr_matrix,
-) -> set[tuple[int, int]]:
-    regex_dfa = regex_to_dfa(regex)
-    adj_dfa = AdjacencyMatrixFA(regex_dfa, matrix_type)
-    graph_nfa = graph_to_nfa(graph, start_nodes, final_nodes)
-    adj_nfa = AdjacencyMatrixFA(graph_nfa, matrix_type)
+    backend: Union[str, MatrixBackend, None] = None,
+    front_update: str = "gather",
+    chunk_size: Optional[int] = None,
+    memory_budget: Optional[int] = None,
+    workers: int = 1,
+    dense_visited_ratio: float = DENSE_VISITED_RATIO,
+    direction: str = "push",
+    as_array: bool = False,
+    columnar: bool = False,
+) -> Union[set[tuple[int, int]], np.ndarray, NodePairs]:
+    adj_dfa = REGEX_CACHE.automaton(regex, matrix_type)
+    adj_nfa = prepare_graph(graph).automaton(start_nodes, final_nodes, matrix_type)
+
+    backend = get_backend(backend, matrix_type)
+    start_states = list(adj_nfa.start_states)
+    if chunk_size is None:
+        if memory_budget is not None:
+            chunk_size = __budget_chunk_size(memory_budget, adj_dfa, adj_nfa, backend)
+        else:
+            chunk_size = -(-len(start_states) // max(workers, 1))
 
-    result = MsBfsRpq(adj_dfa, adj_nfa, matrix_type)()
+    options = dict(
+        matrix_type=matrix_type,
+        backend=backend,
+        front_update=front_update,
+        dense_visited_ratio=dense_visited_ratio,
+        direction=direction,
+    )
+    results = map_chunks(
+        __ms_bfs_chunk,
+        (adj_dfa, adj_nfa, options),
+        split_chunks(start_states, chunk_size),
+        workers,
+    )
 
-    return result
+    # chunks have disjoint start nodes, so their pairs never repeat
+    pairs = np.concatenate(
+        results + [adj_nfa.state_values()[np.empty((0, 2), dtype=np.int64)]]
+    )
+    if as_array:
+        return pairs
+    return make_pairs(pairs[:, 0], pairs[:, 1], columnar)
+
+
+def __single_source_rpq(
+    regex: str,
+    graph: Union[MultiDiGraph, PreparedGraph],
+    start_node: int,
+    final_nodes: Optional[set[int]],
+    matrix_type,
+    backend: Union[str, MatrixBackend, None],
+) -> MsBfsRpq:
+    adj_dfa = REGEX_CACHE.automaton(regex, matrix_type)
+    adj_nfa = prepare_graph(graph).automaton({start_node}, final_nodes, matrix_type)
+    return MsBfsRpq(adj_dfa, adj_nfa, matrix_type, backend)
+
+
+def rpq_exists(
+    regex: str,
+    graph: Union[MultiDiGraph, PreparedGraph],
+    start_node: int,
+    final_node: int,
+    matrix_type=sp.csr_matrix,
+    backend: Union[str, MatrixBackend, None] = None,
+) -> bool:
+    if start_node not in graph or final_node not in graph:
+        return False
+    engine = __single_source_rpq(
+        regex, graph, start_node, {final_node}, matrix_type, backend
+    )
+    return any(len(pairs) for pairs in engine.levels())
+
+
+def rpq_targets(
+    regex: str,
+    graph: Union[MultiDiGraph, PreparedGraph],
+    start_node: int,
+    limit: Optional[int] = None,
+    matrix_type=sp.csr_matrix,
+    backend: Union[str, MatrixBackend, None] = None,
+) -> list[int]:
+    # targets come in order of their shortest path length
+    if start_node not in graph or limit == 0:
+        return []
+    engine = __single_source_rpq(regex, graph, start_node, None, matrix_type, backend)
+    targets = []
+    for pairs in engine.levels():
+        targets.extend(pairs[:, 1].tolist())
+        if limit is not None and len(targets) >= limit:
+            return targets[:limit]
+    return targets
@@ -1,8 +1,13 @@
+from collections import defaultdict
 from itertools import product
+from typing import Hashable, List, Optional, Self, Union
 
 import networkx as nx
 from pyformlang.cfg import Variable, Production, Epsilon, CFG, Terminal
 
+from project.pairs import NodePairs
+from project.task3 import PreparedGraph, prepare_graph
+
 
 def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
     return CFG(
@@ -15,52 +20,123 @@ def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
     ).remove_useless_symbols()
 
 
-def __hellings_init(wnf_cfg: CFG, graph: nx.DiGraph):
+class CompiledGrammar:
+    # weak normal form productions grouped for lookups, with variables
+    # replaced by their numbers
+    variables: List[Variable]
+    variable_ids: dict[Variable, int]
+    start: Optional[int]
+    terminal_heads: dict[Hashable, List[int]]
+    body_heads: dict[tuple[int, int], List[int]]
+    nullable: List[int]
+
+    def __variable_id(self, variable: Variable) -> int:
+        variable_id = self.variable_ids.get(variable)
+        if variable_id is None:
+            variable_id = len(self.variables)
+            self.variables.append(variable)
+            self.variable_ids[variable] = variable_id
+        return variable_id
+
+    def __init__(self, wnf_cfg: CFG):
+        self.variables = []
+        self.variable_ids = dict()
+        terminal_heads = defaultdict(list)
+        body_heads = defaultdict(list)
+        for production in wnf_cfg.productions:
+            head = self.__variable_id(production.head)
+            body = production.body
+            if len(body) == 1 and isinstance(body[0], Terminal):
+                terminal_heads[body[0].value].append(head)
+            elif len(body) == 2:
+                body = (self.__variable_id(body[0]), self.__variable_id(body[1]))
+                body_heads[body].append(head)
+
+        self.terminal_heads = dict(terminal_heads)
+        self.body_heads = dict(body_heads)
+        self.nullable = [
+            self.__variable_id(Variable(var.value))
+            for var in wnf_cfg.get_nullable_symbols()
+        ]
+        self.start = self.variable_ids.get(wnf_cfg.start_symbol)
+
+    def components(self) -> List[dict[tuple[int, int], List[int]]]:
+        # binary productions grouped by the strongly connected component of
+        # their heads in the variable dependency graph, dependencies first
+        dependencies = nx.DiGraph()
+        dependencies.add_nodes_from(range(len(self.variables)))
+        for (B, C), heads in self.body_heads.items():
+            dependencies.add_edges_from((var, head) for var in (B, C) for head in heads)
+
+        condensed = nx.condensation(dependencies)
+        component_of = condensed.graph["mapping"]
+        components = [dict() for _ in range(condensed.number_of_nodes())]
+        for body, heads in self.body_heads.items():
+            for head in heads:
+                components[component_of[head]].setdefault(body, []).append(head)
+        return [
+            components[component]
+            for component in nx.topological_sort(condensed)
+            if components[component]
+        ]
+
+    @classmethod
+    def from_cfg(cls, cfg: CFG) -> Self:
+        return cls(cfg_to_weak_normal_form(cfg))
+
+
+def compile_grammar(cfg: Union[CFG, CompiledGrammar]) -> CompiledGrammar:
+    if isinstance(cfg, CompiledGrammar):
+        return cfg
+    return CompiledGrammar.from_cfg(cfg)
+
+
+def __hellings_init(grammar: CompiledGrammar, graph: PreparedGraph):
     result = set()
-    for u, v, data in graph.edges(data=True):
-        label = data.get("label")
-        if label is not None:
-            for production in wnf_cfg.productions:
-                if len(production.body) == 1 and isinstance(
-                    production.body[0], Terminal
-                ):
-                    terminal = production.body[0].value
-                    if terminal == label:
-                        result.add((u, production.head, v))
-    result |= {
-        (node, var, node)
-        for node, var in product(graph.nodes, wnf_cfg.get_nullable_symbols())
-    }
+    nodes = graph.nodes
+    for terminal, heads in grammar.terminal_heads.items():
+        rows, cols = graph.label_edges(terminal)
+        edges = list(zip(rows.tolist(), cols.tolist()))
+        result |= {(nodes[u], head, nodes[v]) for head in heads for u, v in edges}
+    result |= {(node, var, node) for node, var in product(nodes, grammar.nullable)}
     return result
 
 
-def __hellings_update_extend(wnf_cfg: CFG, result):
-    added = True
-    while added:
-        added = False
-        new_results = set()
-
-        for v1, B, v2 in result:
-            for v2_, C, v3 in result:
-                if v2 == v2_:
-                    for production in wnf_cfg.productions:
-                        if (
-                            len(production.body) == 2
-                            and production.body[0] == B
-                            and production.body[1] == C
-                        ):
-                            new_triple = (v1, production.head, v3)
-                            if new_triple not in result:
-                                new_results.add(new_triple)
-                                added = True
-
-        result |= new_results
-
-
-def __hellings_filter(wnf_cfg: CFG, start_nodes, final_nodes, results):
+def __hellings_update_extend(grammar: CompiledGrammar, result):
+    heads_by_body = grammar.body_heads
+
+    # triples by their first and last vertex
+    outgoing = defaultdict(set)
+    incoming = defaultdict(set)
+    for v1, var, v2 in result:
+        outgoing[v1].add((var, v2))
+        incoming[v2].add((v1, var))
+
+    worklist = list(result)
+    while worklist:
+        v1, B, v2 = worklist.pop()
+        new_triples = [
+            (v1, head, v3)
+            for C, v3 in outgoing[v2]
+            for head in heads_by_body.get((B, C), ())
+        ] + [
+            (v0, head, v2)
+            for v0, A in incoming[v1]
+            for head in heads_by_body.get((A, B), ())
+        ]
+
+        for triple in new_triples:
+            if triple not in result:
+                result.add(triple)
+                outgoing[triple[0]].add((triple[1], triple[2]))
+                incoming[triple[2]].add((triple[0], triple[1]))
+                worklist.append(triple)
+
+
+def __hellings_filter(grammar: CompiledGrammar, start_nodes, final_nodes, results):
     filtered = set()
     for u, var, v in results:
-        if var == wnf_cfg.start_symbol:
+        if var == grammar.start:
             if (not start_nodes or u in start_nodes) and (
                 not final_nodes or v in final_nodes
             ):
@@ -69,15 +145,17 @@ def __hellings_filter(wnf_cfg: CFG, start_nodes, final_nodes, results):
 
 
 def hellings_based_cfpq(
-    cfg: CFG,
-    graph: nx.DiGraph,
+    cfg: Union[CFG, CompiledGrammar],
+    graph: Union[nx.DiGraph, PreparedGraph],
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
-) -> set[tuple[int, int]]:
-    weak_normal_form = cfg_to_weak_normal_form(cfg)
+    columnar: bool = False,
+) -> Union[set[tuple[int, int]], NodePairs]:
+    grammar = compile_grammar(cfg)
 
-    cfpq_results = __hellings_init(weak_normal_form, graph)
+    cfpq_results = __hellings_init(grammar, prepare_graph(graph))
 
-    __hellings_update_extend(weak_normal_form, cfpq_results)
+    __hellings_update_extend(grammar, cfpq_results)
 
-    return __hellings_filter(weak_normal_form, start_nodes, final_nodes, cfpq_results)
+    result = __hellings_filter(grammar, start_nodes, final_nodes, cfpq_results)
+    return NodePairs.from_pairs(result) if columnar else result
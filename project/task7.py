@@ -1,95 +1,129 @@
 from collections import defaultdict
 from dataclasses import dataclass
 import networkx as nx
-from pyformlang.cfg import CFG, Terminal, Variable
+from pyformlang.cfg import CFG
+import numpy as np
 from scipy.sparse import csr_matrix
-from project.task6 import cfg_to_weak_normal_form
+from typing import Union
+from project.matrix_backend import MatrixBackend, get_backend
+from project.pairs import NodePairs, make_pairs, node_array
+from project.task3 import PreparedGraph, prepare_graph
+from project.task6 import CompiledGrammar, compile_grammar
 
 
 @dataclass
 class __AlgoData:
-    def __init__(self, wnf, graph, matrix_type):
-        self.wnf: CFG = wnf
-        self.graph: nx.DiGraph = graph
+    def __init__(self, grammar, graph, backend):
+        self.grammar: CompiledGrammar = grammar
+        self.graph: PreparedGraph = graph
         self.nodes_amount = graph.number_of_nodes()
-        self.index_to_node = list(graph.nodes())
-        self.node_to_index = {node: idx for idx, node in enumerate(self.index_to_node)}
-        self.matrix_type = matrix_type
+        self.index_to_node = graph.nodes
+        self.node_to_index = graph.node_to_num
+        self.backend: MatrixBackend = backend
+        self.shape = (self.nodes_amount, self.nodes_amount)
 
 
 def __init_var_matrices(adata: __AlgoData):
-    var_matrices = defaultdict(
-        lambda: adata.matrix_type((adata.nodes_amount, adata.nodes_amount), dtype=bool)
-    )
-    for u, v, data in adata.graph.edges(data=True):
-        label = data.get("label")
-        if label is not None:
-            for production in adata.wnf.productions:
-                if len(production.body) == 1 and isinstance(
-                    production.body[0], Terminal
-                ):
-                    terminal = production.body[0].value
-                    if terminal == label:
-                        head = production.head
-                        var_matrices[head][
-                            adata.node_to_index[u], adata.node_to_index[v]
-                        ] = True
+    var_edges = defaultdict(list)
+    for terminal, heads in adata.grammar.terminal_heads.items():
+        edges = adata.graph.label_edges(terminal)
+        for head in heads:
+            var_edges[head].append(edges)
+
+    var_matrices = defaultdict(lambda: adata.backend.empty(adata.shape))
+    for head, edges in var_edges.items():
+        var_matrices[head] = adata.backend.build(
+            adata.shape,
+            np.concatenate([rows for rows, _ in edges]),
+            np.concatenate([cols for _, cols in edges]),
+        )
     return var_matrices
 
 
 def __add_nullable(adata: __AlgoData, var_matrices):
-    nullable = adata.wnf.get_nullable_symbols()
-    for node in adata.graph.nodes:
-        for var in nullable:
-            var = Variable(var.value)
-            var_matrices[var][adata.node_to_index[node], adata.node_to_index[node]] = (
-                True
-            )
+    nodes = np.arange(adata.nodes_amount)
+    identity = adata.backend.build(adata.shape, nodes, nodes)
+    for var in adata.grammar.nullable:
+        var_matrices[var] = adata.backend.add(var_matrices[var], identity)
+
+
+def __component_fixpoint(adata: __AlgoData, var_matrices, bodies):
+    # bodies of the first step are multiplied in full, later steps are
+    # semi-naive: only ΔB·C + B·ΔC can give new pairs. Variables of earlier
+    # components are final and never get a delta, so a non-recursive
+    # component is done after one step
+    backend = adata.backend
+    deltas = None
+    while deltas is None or deltas:
+        products = dict()
+        for (B, C), heads in bodies.items():
+            if B not in var_matrices or C not in var_matrices:
+                continue
+            if deltas is None:
+                parts = [backend.multiply(var_matrices[B], var_matrices[C])]
+            else:
+                parts = []
+                if B in deltas:
+                    parts.append(backend.multiply(deltas[B], var_matrices[C]))
+                if C in deltas:
+                    parts.append(backend.multiply(var_matrices[B], deltas[C]))
+            for part in parts:
+                for head in heads:
+                    products[head] = (
+                        backend.add(products[head], part) if head in products else part
+                    )
+
+        deltas = dict()
+        for head, product in products.items():
+            new_mat = backend.difference(product, var_matrices[head])
+            if backend.nnz(new_mat):
+                var_matrices[head] = backend.add(var_matrices[head], new_mat)
+                deltas[head] = new_mat
 
 
 def __matrix_hellings(adata: __AlgoData, var_matrices):
-    added = True
-    while added:
-        added = False
-        for production in adata.wnf.productions:
-            if len(production.body) == 2:
-                B = Variable(production.body[0].value)
-                C = Variable(production.body[1].value)
-                head = production.head
-                if B in var_matrices and C in var_matrices:
-                    new_mat = var_matrices[B] @ var_matrices[C]
-
-                    for u, v in zip(*new_mat.nonzero()):
-                        if not var_matrices[head][u, v]:
-                            var_matrices[head][u, v] = True
-                            added = True
-
-
-def __get_results(adata: __AlgoData, var_matrices, start_nodes, final_nodes):
-    result_pairs = set()
-    start_symbol = adata.wnf.start_symbol
-    if start_symbol in var_matrices:
-        result_pairs |= {
-            (u, v)
-            for u, v in map(
-                lambda pair: map(lambda i: adata.index_to_node[i], pair),
-                zip(*var_matrices[start_symbol].nonzero()),
-            )
-            if (not start_nodes or u in start_nodes)
-            and (not final_nodes or v in final_nodes)
-        }
-    return result_pairs
+    for bodies in adata.grammar.components():
+        __component_fixpoint(adata, var_matrices, bodies)
+
+
+def __nodes_mask(adata: __AlgoData, nodes) -> np.ndarray:
+    if not nodes:
+        return np.ones(adata.nodes_amount, dtype=bool)
+    mask = np.zeros(adata.nodes_amount, dtype=bool)
+    mask[
+        [adata.node_to_index[node] for node in nodes if node in adata.node_to_index]
+    ] = True
+    return mask
+
+
+def __get_results(
+    adata: __AlgoData, var_matrices, start_nodes, final_nodes, columnar: bool
+):
+    start = adata.grammar.start
+    if start in var_matrices:
+        rows, cols = adata.backend.extract_pairs(var_matrices[start])
+    else:
+        rows, cols = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    mask = (
+        __nodes_mask(adata, start_nodes)[rows] & __nodes_mask(adata, final_nodes)[cols]
+    )
+    nodes = node_array(adata.index_to_node)
+    return make_pairs(nodes[rows[mask]], nodes[cols[mask]], columnar)
 
 
 def matrix_based_cfpq(
-    cfg: CFG,
-    graph: nx.DiGraph,
+    cfg: Union[CFG, CompiledGrammar],
+    graph: Union[nx.DiGraph, PreparedGraph],
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
     matrix_type=csr_matrix,
-) -> set[tuple[int, int]]:
-    weak_normal_form = cfg_to_weak_normal_form(cfg)
-    adata = __AlgoData(weak_normal_form, graph, matrix_type)
+    backend: Union[str, MatrixBackend, None] = None,
+    columnar: bool = False,
+) -> Union[set[tuple[int, int]], NodePairs]:
+    adata = __AlgoData(
+        compile_grammar(cfg), prepare_graph(graph), get_backend(backend, matrix_type)
+    )
 
     var_matrices = __init_var_matrices(adata)
 
@@ -97,4 +131,4 @@ def matrix_based_cfpq(
 
     __matrix_hellings(adata, var_matrices)
 
-    return __get_results(adata, var_matrices, start_nodes, final_nodes)
+    return __get_results(adata, var_matrices, start_nodes, final_nodes, columnar)
@@ -1,11 +1,18 @@
-from itertools import product
 import networkx as nx
+import numpy as np
 import scipy.sparse as sp
 from pyformlang import rsa, cfg as pycfg
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, State
-from project.task3 import AdjacencyMatrixFA, intersect_automata
-from project.task2 import graph_to_nfa
-from typing import Set, Tuple
+from project.alphabet import ALPHABET
+from project.matrix_backend import MatrixBackend, get_backend
+from project.pairs import NodePairs, make_pairs
+from project.task3 import (
+    AdjacencyMatrixFA,
+    PreparedGraph,
+    intersect_automata,
+    prepare_graph,
+)
+from typing import Set, Tuple, Union
 
 
 def cfg_to_rsm(cfg: pycfg.CFG) -> rsa.RecursiveAutomaton:
@@ -36,62 +43,67 @@ def bool_decomposed_rsm(rsm: rsa.RecursiveAutomaton) -> AdjacencyMatrixFA:
     return AdjacencyMatrixFA(nfa)
 
 
-def __compute_closure(decomposed_rsa, decomposed_graph, rsm):
-    last_nonzero_number = 0
-    current_nonzero_number = None
+def __compute_closure(decomposed_rsa, decomposed_graph, backend: MatrixBackend):
+    rsa_states_number = decomposed_rsa.states_number
+    graph_states_number = decomposed_graph.states_number
 
-    while last_nonzero_number != current_nonzero_number:
-        last_nonzero_number = current_nonzero_number
+    box_ids = np.array(
+        [ALPHABET.intern(state.value[0]) for state in decomposed_rsa.num_to_state],
+        dtype=np.int64,
+    )
+    is_box_start = np.zeros(rsa_states_number, dtype=bool)
+    is_box_start[list(decomposed_rsa.start_states)] = True
+    is_box_final = np.zeros(rsa_states_number, dtype=bool)
+    is_box_final[list(decomposed_rsa.final_states)] = True
+
+    added = True
+    while added:
+        added = False
         intersection = intersect_automata(decomposed_rsa, decomposed_graph)
 
-        transitive_closure = intersection.transitive_closure()
-
-        for row_index, column_index in zip(*transitive_closure.nonzero()):
-            row_state = intersection.num_to_state[row_index]
-            column_state = intersection.num_to_state[column_index]
-
-            row_inside_state, row_graph_state = row_state.value
-            row_symbol, row_rsm_state = row_inside_state.value
-            column_inside_state, column_graph_state = column_state.value
-            column_symbol, column_rsm_state = column_inside_state.value
+        transitive_closure = intersection.transitive_closure(backend=backend)
+
+        # product state index is rsa_index * graph_states_number + graph_index
+        rows, cols = backend.extract_pairs(transitive_closure)
+        row_rsa, row_graph = np.divmod(rows, graph_states_number)
+        column_rsa, column_graph = np.divmod(cols, graph_states_number)
+        row_boxes = box_ids[row_rsa]
+        mask = (
+            (row_boxes == box_ids[column_rsa])
+            & is_box_start[row_rsa]
+            & is_box_final[column_rsa]
+        )
 
-            if (
-                row_symbol == column_symbol
-                and row_rsm_state in rsm.boxes[row_symbol].dfa.start_states
-                and column_rsm_state in rsm.boxes[row_symbol].dfa.final_states
+        for box_id in np.unique(row_boxes[mask]).tolist():
+            box_mask = mask & (row_boxes == box_id)
+            if decomposed_graph.add_edges(
+                box_id, row_graph[box_mask], column_graph[box_mask]
             ):
-                row_graph_index = decomposed_graph.states_to_num[row_graph_state]
-                column_graph_index = decomposed_graph.states_to_num[column_graph_state]
-
-                decomposed_graph.adj_matrices[row_symbol][
-                    row_graph_index, column_graph_index
-                ] = True
-
-        current_nonzero_number = sum(
-            decomposed_graph.adj_matrices[nonterminal].count_nonzero()
-            for nonterminal in decomposed_graph.adj_matrices
-        )
+                added = True
 
 
 def tensor_based_cfpq(
     rsm: rsa.RecursiveAutomaton,
-    graph: nx.DiGraph,
+    graph: Union[nx.DiGraph, PreparedGraph],
     start_nodes: Set[int] | None = None,
     final_nodes: Set[int] | None = None,
     matrix_type=sp.csr_matrix,
-) -> Set[Tuple[int, int]]:
+    backend: Union[str, MatrixBackend, None] = None,
+    columnar: bool = False,
+) -> Union[Set[Tuple[int, int]], NodePairs]:
     decomposed_rsa = bool_decomposed_rsm(rsm)
-    decomposed_graph = AdjacencyMatrixFA(
-        graph_to_nfa(graph, start_nodes, final_nodes), matrix_type=matrix_type
+    decomposed_graph = prepare_graph(graph).automaton(
+        start_nodes, final_nodes, matrix_type
     )
 
-    __compute_closure(decomposed_rsa, decomposed_graph, rsm)
+    __compute_closure(decomposed_rsa, decomposed_graph, get_backend(backend))
 
-    answer = {
-        (decomposed_graph.num_to_state[n], decomposed_graph.num_to_state[m])
-        for n, m in product(
-            decomposed_graph.start_states, decomposed_graph.final_states
-        )
-        if decomposed_graph.adj_matrices[rsm.initial_label][n, m]
-    }
-    return answer
+    rows, cols = decomposed_graph.adj_matrices[rsm.initial_label].nonzero()
+    is_start = np.zeros(decomposed_graph.states_number, dtype=bool)
+    is_start[list(decomposed_graph.start_states)] = True
+    is_final = np.zeros(decomposed_graph.states_number, dtype=bool)
+    is_final[list(decomposed_graph.final_states)] = True
+
+    mask = is_start[rows] & is_final[cols]
+    nodes = decomposed_graph.state_values()
+    return make_pairs(nodes[rows[mask]], nodes[cols[mask]], columnar)
@@ -1,10 +1,13 @@
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, Set, Tuple, Self, TypeVar
+from typing import Dict, Set, Tuple, Self, TypeVar, Union
 from pyformlang.finite_automaton import Symbol
 import networkx as nx
 from pyformlang import rsa
 
+from project.pairs import NodePairs
+from project.task3 import PreparedGraph, prepare_graph
+
 
 @dataclass(frozen=True)
 class RsmState:
@@ -81,19 +84,21 @@ class GllCFPQSolver:
     rsmstate2data: Dict[Symbol, Dict[str, RsmStateData]]
     start_rstate: RsmState
     rsm: rsa.RecursiveAutomaton
-    graph: nx.DiGraph
+    graph: Union[nx.DiGraph, PreparedGraph]
     gss: GSStack
     accept_gssnode: GSSNode
     unprocessed: Set[SPPFNode]
     added: Set[SPPFNode]
 
     @staticmethod
-    def _init_graph_data(graph: nx.DiGraph):
+    def _init_graph_data(graph: PreparedGraph):
         nodes2edges = defaultdict(lambda: defaultdict(set))
 
-        for from_n, to_n, symb in graph.edges(data="label"):
-            if symb is not None:
-                nodes2edges[from_n][symb].add(to_n)
+        nodes = graph.nodes
+        for symb in graph.labels:
+            from_ns, to_ns = graph.label_edges(symb)
+            for from_n, to_n in zip(from_ns.tolist(), to_ns.tolist()):
+                nodes2edges[nodes[from_n]][symb].add(nodes[to_n])
         return nodes2edges
 
     @staticmethod
@@ -127,9 +132,9 @@ class GllCFPQSolver:
     def __init__(
         self,
         rsm: rsa.RecursiveAutomaton,
-        graph: nx.DiGraph,
+        graph: Union[nx.DiGraph, PreparedGraph],
     ):
-        self.nodes2edges = self._init_graph_data(graph)
+        self.nodes2edges = self._init_graph_data(prepare_graph(graph))
         self.rsmstate2data = self._init_rsm_data(rsm)
 
         start_symb = rsm.initial_label
@@ -243,13 +248,15 @@ class GllCFPQSolver:
 
 def gll_based_cfpq(
     rsm: rsa.RecursiveAutomaton,
-    graph: nx.DiGraph,
+    graph: Union[nx.DiGraph, PreparedGraph],
     start_nodes: Set[int] | None = None,
     final_nodes: Set[int] | None = None,
-) -> Set[Tuple[int, int]]:
+    columnar: bool = False,
+) -> Set[Tuple[int, int]] | NodePairs:
+    graph = prepare_graph(graph)
     solver = GllCFPQSolver(rsm, graph)
     result = solver(
-        start_nodes if start_nodes else graph.nodes(),
-        final_nodes if final_nodes else graph.nodes(),
+        start_nodes if start_nodes else graph.nodes,
+        final_nodes if final_nodes else graph.nodes,
     )
-    return result
+    return NodePairs.from_pairs(result) if columnar else result
@@ -0,0 +1,44 @@
+import random
+import sys
+import time
+
+import shared
+
+sys.path.append(str(shared.ROOT))
+
+from project.task2 import regex_to_dfa  # noqa: E402
+from project.task3 import AdjacencyMatrixFA  # noqa: E402
+
+REGEX = "(a | b)* c (a | b | c)* (d | e)"
+ALPHABET = "abcde"
+WORDS_NUMBER = 20000
+MAX_WORD_LENGTH = 12
+
+
+def measure(name, words_number, fun):
+    start = time.perf_counter()
+    result = fun()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>14}: {elapsed:8.3f} s, {words_number / elapsed:10.0f} words/s")
+    return result
+
+
+def main():
+    random.seed(0)
+    adj_fa = AdjacencyMatrixFA(regex_to_dfa(REGEX))
+    words = [
+        [random.choice(ALPHABET) for _ in range(random.randint(0, MAX_WORD_LENGTH))]
+        for _ in range(WORDS_NUMBER)
+    ]
+
+    per_word = measure(
+        "accepts", WORDS_NUMBER, lambda: [adj_fa.accepts(word) for word in words]
+    )
+    batch = measure("accepts_batch", WORDS_NUMBER, lambda: adj_fa.accepts_batch(words))
+    many = measure("accepts_many", WORDS_NUMBER, lambda: adj_fa.accepts_many(words))
+
+    assert per_word == batch == many.tolist()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from project.matrix_backend import BACKENDS, get_backend
+
+
+class TestMatrixBackends:
+    def test_operations_agree(self):
+        rng = np.random.default_rng(0)
+        left = sp.random(70, 90, density=0.05, random_state=rng, format="csr") > 0
+        right = sp.random(90, 70, density=0.05, random_state=rng, format="csr") > 0
+        other = sp.random(70, 70, density=0.1, random_state=rng, format="csr") > 0
+        product = left @ right
+
+        for name in BACKENDS:
+            backend = get_backend(name)
+            m_left, m_right = backend.convert(left), backend.convert(right)
+            m_other = backend.convert(other)
+            m_product = backend.multiply(m_left, m_right)
+            assert backend.nnz(m_product) == product.count_nonzero()
+            for actual, expected in [
+                (m_product, product),
+                (backend.add(m_product, m_other), product + other),
+                (backend.difference(m_product, m_other), product > other),
+            ]:
+                assert set(zip(*backend.extract_pairs(actual))) == set(
+                    zip(*expected.nonzero())
+                )
+
+            rows, cols = np.array([0, 3, 3]), np.array([69, 0, 64])
+            built = backend.build((4, 70), rows, cols)
+            assert set(zip(*backend.extract_pairs(built))) == set(zip(rows, cols))
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            get_backend("dense")
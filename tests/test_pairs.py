@@ -0,0 +1,57 @@
+import networkx as nx
+import numpy as np
+from cfpq_data import labeled_two_cycles_graph
+from pyformlang.cfg import CFG
+
+from project.pairs import NodePairs
+from project.task3 import tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
+from project.task6 import hellings_based_cfpq
+from project.task7 import matrix_based_cfpq
+from project.task8 import cfg_to_rsm, tensor_based_cfpq
+from project.task9 import gll_based_cfpq
+
+
+class TestNodePairs:
+    def test_set_operations(self):
+        pairs = NodePairs(np.array([3, 1, 1, 3, 2]), np.array([0, 5, 2, 0, 2]))
+        assert len(pairs) == 4
+        assert list(pairs) == [(1, 2), (1, 5), (2, 2), (3, 0)]
+        assert (1, 5) in pairs and (3, 0) in pairs
+        assert (1, 3) not in pairs and (4, 0) not in pairs and "a" not in pairs
+        assert pairs == {(1, 2), (1, 5), (2, 2), (3, 0)}
+        assert pairs.to_set() == {(1, 2), (1, 5), (2, 2), (3, 0)}
+        assert pairs & {(1, 5), (7, 7)} == {(1, 5)}
+        assert pairs.to_numpy().shape == (4, 2)
+
+    def test_object_nodes(self):
+        pairs = NodePairs.from_pairs([("a", 1), ("b", "c"), ("a", 1)])
+        assert len(pairs) == 2
+        assert ("a", 1) in pairs and ("b", "c") in pairs
+        assert ("a", "c") not in pairs
+
+    def test_empty(self):
+        pairs = NodePairs.from_pairs([])
+        assert len(pairs) == 0 and (0, 0) not in pairs and pairs == set()
+
+
+class TestColumnarResults:
+    def test_rpq(self):
+        graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+        for regex in ["a*.b", "(a|b)*"]:
+            expected = tensor_based_rpq(regex, graph, {0, 1}, set())
+            for rpq in [tensor_based_rpq, ms_bfs_based_rpq]:
+                actual = rpq(regex, graph, {0, 1}, set(), columnar=True)
+                assert isinstance(actual, NodePairs)
+                assert actual == expected
+
+    def test_cfpq(self):
+        graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+        graph = nx.relabel_nodes(graph, {0: "zero"})
+        cfg = CFG.from_text("S -> a S b | a b")
+        expected = hellings_based_cfpq(cfg, graph)
+        assert hellings_based_cfpq(cfg, graph, columnar=True) == expected
+        assert matrix_based_cfpq(cfg, graph, columnar=True) == expected
+        rsm = cfg_to_rsm(cfg)
+        assert tensor_based_cfpq(rsm, graph, columnar=True) == expected
+        assert gll_based_cfpq(rsm, graph, columnar=True) == expected
@@ -0,0 +1,70 @@
+import pytest
+import scipy.sparse as sp
+
+from project.regex_cache import RegexCache
+from project.task3 import AdjacencyMatrixFA
+from utils import str2symbols
+
+
+class TestRegexCache:
+    def test_hits_and_eviction(self):
+        cache = RegexCache(AdjacencyMatrixFA, maxsize=2)
+        first = cache.automaton("a . b*", sp.csr_matrix)
+        assert cache.automaton(" a .  b* ", sp.csr_matrix) is first
+        assert cache.dfa("a . b*") is cache.dfa("a . b*")
+        assert cache.automaton("a . b*", sp.lil_matrix) is not first
+        assert tuple(cache.stats()) == (4, 1, 2, 1)
+
+        cache.dfa("c")
+        cache.dfa("a . b*")
+        cache.dfa("d")
+        assert cache.stats().currsize == 2
+        cache.dfa("c")
+        assert cache.stats().misses == 4
+        cache.clear()
+        assert tuple(cache.stats()) == (0, 0, 2, 0)
+
+    def test_persistence(self, tmp_path):
+        path = str(tmp_path / "regexes.pickle")
+        cache = RegexCache(AdjacencyMatrixFA, path=path)
+        dfa = cache.dfa("(a|b)* . c")
+        cache.save()
+
+        restored = RegexCache(AdjacencyMatrixFA, path=path)
+        assert restored.stats().currsize == 1
+        assert restored.dfa("(a|b)*  . c").is_equivalent_to(dfa)
+        assert restored.stats().hits == 1
+        adj_fa = restored.automaton("(a|b)* . c", sp.csr_matrix)
+        assert adj_fa.accepts(str2symbols("abc"))
+        assert not adj_fa.accepts(str2symbols("ab"))
+
+    def test_save_without_path(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        cache = RegexCache(AdjacencyMatrixFA)
+        cache.dfa("a")
+        with pytest.raises(ValueError):
+            cache.save()
+        with pytest.raises(ValueError):
+            cache.load()
+        assert list(tmp_path.iterdir()) == []
+
+    def test_persist_to(self, tmp_path):
+        path = str(tmp_path / "regexes.pickle")
+        cache = RegexCache(AdjacencyMatrixFA)
+        cache.persist_to(path, save_at_exit=False)
+        cache.dfa("a b*")
+        cache.save()
+
+        restored = RegexCache(AdjacencyMatrixFA)
+        restored.persist_to(path, save_at_exit=False)
+        restored.dfa("a  b*")
+        assert tuple(restored.stats()) == (1, 0, 256, 1)
+
+    def test_other_whitespace_is_kept(self):
+        cache = RegexCache(AdjacencyMatrixFA)
+        tab_fa = cache.automaton("a\tb", sp.csr_matrix)
+        assert cache.automaton("a b", sp.csr_matrix) is not tab_fa
+        assert cache.automaton("a\nb", sp.csr_matrix) is not tab_fa
+        assert tab_fa.accepts(["a\tb"])
+        assert not tab_fa.accepts(["a", "b"])
+        assert cache.stats().currsize == 3
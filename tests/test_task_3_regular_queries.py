@@ -1,8 +1,29 @@
-from project.task3 import AdjacencyMatrixFA
-from project.task2 import regex_to_dfa
+from cfpq_data import labeled_two_cycles_graph
+from pyformlang.finite_automaton import Symbol
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from project.alphabet import ALPHABET
+from project.matrix_backend import BACKENDS
+from project.task3 import (
+    AdjacencyMatrixFA,
+    LazyIntersectionFA,
+    PreparedGraph,
+    tensor_based_rpq,
+)
+from project.task4 import ms_bfs_based_rpq, rpq_exists, rpq_targets
+from project.task2 import regex_to_dfa, graph_to_nfa
 from utils import str2symbols
 
 
+# a -> cycle 0 1 2 3 0, b -> cycle 0 4 5 6 7 0
+@pytest.fixture(scope="module")
+def graph():
+    return labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+
+
 class TestAdjacencyMatrixFA:
     def test_simple_regex(self):
         dfa = regex_to_dfa("a.(a|b)*")
@@ -15,12 +36,63 @@ class TestAdjacencyMatrixFA:
         assert not adj_fa.accepts(str2symbols("ba"))
         assert not adj_fa.accepts([])
 
+    def test_accepts_batch(self):
+        adj_fa = AdjacencyMatrixFA(regex_to_dfa("a.(a|b)*"))
+        words = ["a", "ab", "aa", "aaba", "ba", "", "abc", "aab", "b"]
+        assert adj_fa.accepts_batch(map(str2symbols, words)) == [
+            adj_fa.accepts(str2symbols(word)) for word in words
+        ]
+        assert adj_fa.accepts_batch([]) == []
+
+    def test_accepts_many(self, graph):
+        adj_fa = AdjacencyMatrixFA(regex_to_dfa("a.(a|b)*"))
+        words = ["a", "ab", "aa", "aaba", "ba", "", "abc", "aab", "b"]
+        assert adj_fa.accepts_many(map(str2symbols, words)).tolist() == [
+            adj_fa.accepts(str2symbols(word)) for word in words
+        ]
+        assert adj_fa.accepts_many([]).tolist() == []
+
+        # several start states and nondeterministic steps
+        graph_fa = AdjacencyMatrixFA.from_graph(graph, {0, 5}, {2})
+        words = ["", "a", "aa", "bbaa", "aaaa", "ab", "bbbbbaa", "c"]
+        assert graph_fa.accepts_many(words).tolist() == [
+            graph_fa.accepts(str2symbols(word)) for word in words
+        ]
+
+        lazy_fa = LazyIntersectionFA(adj_fa, graph_fa)
+        words = ["", "a", "aa", "ab", "aab", "abab", "c"]
+        assert lazy_fa.accepts_many(map(str2symbols, words)).tolist() == [
+            lazy_fa.accepts(str2symbols(word)) for word in words
+        ]
+        assert lazy_fa.accepts_many([]).tolist() == []
+
+    def test_in_place_edits_after_query(self):
+        adj_fa = AdjacencyMatrixFA(regex_to_dfa("a b"))
+        assert not adj_fa.accepts(str2symbols("aab"))
+        assert not adj_fa.accepts_many([str2symbols("aab")])[0]
+        for state in range(adj_fa.states_number):
+            adj_fa.adj_matrices[Symbol("a")][state, state] = True
+        assert adj_fa.accepts(str2symbols("aab"))
+        assert adj_fa.accepts_many([str2symbols("aab")])[0]
+
     def test_empty_regex(self):
         dfa = regex_to_dfa("")
         adj_matrix = AdjacencyMatrixFA(dfa)
         assert adj_matrix.is_empty()
         assert not adj_matrix.accepts(str2symbols("a"))
 
+    def test_epsilon_regex(self):
+        adj_fa = AdjacencyMatrixFA(regex_to_dfa("$"))
+        assert not adj_fa.is_empty()
+        assert adj_fa.accepts([])
+        assert not adj_fa.accepts(str2symbols("a"))
+
+    def test_empty_intersection(self):
+        dfa1 = AdjacencyMatrixFA(regex_to_dfa("a"))
+        dfa2 = AdjacencyMatrixFA(regex_to_dfa("(a a)*"))
+        assert AdjacencyMatrixFA.from_intersect(dfa1, dfa2).is_empty()
+        assert LazyIntersectionFA(dfa1, dfa2).is_empty()
+
     def test_intersection(self):
         dfa1 = AdjacencyMatrixFA(regex_to_dfa("a b c*"))
         dfa2 = AdjacencyMatrixFA(regex_to_dfa("(a | b | c)*(d | e | f)*"))
@@ -28,3 +100,259 @@ class TestAdjacencyMatrixFA:
         assert not adj_matrix.is_empty()
         assert adj_matrix.accepts(str2symbols("abcc"))
         assert not adj_matrix.accepts(str2symbols("def"))
+
+    def test_product_states(self):
+        dfa1 = AdjacencyMatrixFA(regex_to_dfa("a b c*"))
+        dfa2 = AdjacencyMatrixFA(regex_to_dfa("(a | b | c)*(d | e | f)*"))
+        adj_matrix = AdjacencyMatrixFA.from_intersect(dfa1, dfa2)
+        assert len(adj_matrix.num_to_state) == adj_matrix.states_number
+        assert len(adj_matrix.states_to_num) == adj_matrix.states_number
+        for num, state in enumerate(adj_matrix.num_to_state):
+            assert adj_matrix.states_to_num[state] == num
+        st1, st2 = adj_matrix.num_to_state[-1].value
+        assert st1 == dfa1.num_to_state[-1] and st2 == dfa2.num_to_state[-1]
+
+    def test_shared_alphabet(self):
+        dfa1 = AdjacencyMatrixFA(regex_to_dfa("a b c*"))
+        dfa2 = AdjacencyMatrixFA(regex_to_dfa("c* d"))
+        a_id, c_id, d_id = (ALPHABET.find(label) for label in "acd")
+        assert {a_id, c_id} <= set(dfa1.symbol_ids())
+        assert dfa2.matrix(a_id) is None
+        assert Symbol("d") in dfa2.adj_matrices
+        assert "d" not in dfa1.adj_matrices
+        intersection = AdjacencyMatrixFA.from_intersect(dfa1, dfa2)
+        assert intersection.symbol_ids() == [c_id]
+        assert intersection.is_empty()
+        assert d_id not in intersection.symbol_ids()
+
+    def test_lazy_intersection(self):
+        dfa1 = AdjacencyMatrixFA(regex_to_dfa("a b c*"))
+        dfa2 = AdjacencyMatrixFA(regex_to_dfa("(a | b | c)*(d | e | f)*"))
+        dfa3 = AdjacencyMatrixFA(regex_to_dfa("d e f"))
+        eager = AdjacencyMatrixFA.from_intersect(dfa1, dfa2)
+        lazy = LazyIntersectionFA(dfa1, dfa2)
+        assert not lazy.is_empty()
+        assert LazyIntersectionFA(dfa1, dfa3).is_empty()
+        for word in ["abcc", "ab", "def", "abd", ""]:
+            assert lazy.accepts(str2symbols(word)) == eager.accepts(str2symbols(word))
+        assert set(zip(*lazy.transitive_closure().nonzero())) == set(
+            zip(*eager.transitive_closure().nonzero())
+        )
+
+    def test_closure_methods(self):
+        dfa1 = AdjacencyMatrixFA(regex_to_dfa("a b c*"))
+        dfa2 = AdjacencyMatrixFA(regex_to_dfa("(a | b | c)*(d | e | f)*"))
+        adj_matrix = AdjacencyMatrixFA.from_intersect(dfa1, dfa2)
+        expected = set(zip(*adj_matrix.transitive_closure("pow").nonzero()))
+        for method in ["delta", "squaring"]:
+            closure = adj_matrix.transitive_closure(method)
+            assert set(zip(*closure.nonzero())) == expected
+
+    def test_from_graph(self, graph):
+        nfa_fa = AdjacencyMatrixFA(graph_to_nfa(graph, {0}, {2, 5}))
+        graph_fa = AdjacencyMatrixFA.from_graph(graph, {0}, {2, 5})
+        assert graph_fa.states_number == graph.number_of_nodes()
+        assert nfa_fa.adj_matrices.keys() == graph_fa.adj_matrices.keys()
+        for word in ["", "a", "aaa", "aaab", "b", "bbbb", "abb"]:
+            assert graph_fa.accepts(str2symbols(word)) == nfa_fa.accepts(
+                str2symbols(word)
+            )
+
+    def test_add_edges(self, graph):
+        prepared = PreparedGraph(graph)
+        graph_fa = prepared.automaton()
+        a_id = ALPHABET.find("a")
+        shared = graph_fa.matrix(a_id)
+        assert graph_fa.add_edges(a_id, np.array([0, 0, 0]), np.array([0, 0, 2])) == 2
+        assert graph_fa.add_edges(a_id, np.array([0, 1]), np.array([2, 2])) == 0
+        assert shared.count_nonzero() == 4
+        assert prepared.automaton().matrix(a_id) is shared
+
+        matrix = graph_fa.matrix(a_id)
+        assert matrix.format == "csr" and matrix.has_canonical_format
+        assert matrix.count_nonzero() == 6
+
+        c_id = ALPHABET.intern("c")
+        assert graph_fa.add_edges(c_id, np.array([3]), np.array([4])) == 1
+        assert graph_fa.accepts(str2symbols("c"))
+
+
+class TestTensorBasedRpq:
+    @pytest.mark.parametrize(
+        "regex, start_nodes, final_nodes, expected",
+        [
+            ("a*.b", {0, 1}, None, {(0, 4), (1, 4)}),
+            ("b b", {0, 5}, None, {(0, 5), (5, 7)}),
+            ("a a", None, {2}, {(0, 2)}),
+            ("(a|b)*", {6}, {1, 7}, {(6, 1), (6, 7)}),
+            ("a b", None, None, {(3, 4)}),
+        ],
+    )
+    def test_known_answers(self, graph, regex, start_nodes, final_nodes, expected):
+        for method in ["pow", "delta", "squaring", "sources"]:
+            actual = tensor_based_rpq(
+                regex, graph, start_nodes, final_nodes, closure_method=method
+            )
+            assert actual == expected
+        assert ms_bfs_based_rpq(regex, graph, start_nodes, final_nodes) == expected
+
+    def test_known_targets(self, graph):
+        assert rpq_targets("a*", graph, 0) == [0, 1, 2, 3]
+        assert rpq_targets("b*", graph, 5, limit=2) == [5, 6]
+        assert rpq_exists("a b", graph, 3, 4)
+        assert not rpq_exists("a b", graph, 0, 4)
+
+    def test_closure_methods_agree(self, graph):
+        start_nodes, final_nodes = {0, 1}, {0, 2, 5}
+        expected = tensor_based_rpq(
+            "a*.b", graph, start_nodes, final_nodes, closure_method="pow"
+        )
+        for method in ["delta", "squaring", "sources", None]:
+            assert (
+                tensor_based_rpq(
+                    "a*.b", graph, start_nodes, final_nodes, closure_method=method
+                )
+                == expected
+            )
+
+    def test_all_nodes_by_default(self, graph):
+        nodes = set(graph.nodes)
+        expected = tensor_based_rpq("a*", graph, nodes, nodes)
+        assert tensor_based_rpq("a*", graph, None, None) == expected
+        assert tensor_based_rpq("a*", graph, set(), set()) == expected
+        assert ms_bfs_based_rpq("a*", graph, None, None) == expected
+
+    def test_unknown_nodes_are_skipped(self, graph):
+        for rpq in [tensor_based_rpq, ms_bfs_based_rpq]:
+            assert rpq("a*", graph, {0, 99}, {1}) == {(0, 1)}
+            assert rpq("a*", graph, {99}, {1}) == set()
+
+    def test_whitespace_in_labels(self):
+        graph = nx.MultiDiGraph()
+        graph.add_edge(0, 1, label="a\tb")
+        graph.add_edge(1, 2, label="a")
+        graph.add_edge(2, 3, label="b")
+        for rpq in [tensor_based_rpq, ms_bfs_based_rpq]:
+            assert rpq("a\tb", graph, None, None) == {(0, 1)}
+            assert rpq("a b", graph, None, None) == {(1, 3)}
+
+    def test_lazy_intersection(self, graph):
+        start_nodes, final_nodes = {0, 1, 4}, {0, 2, 5}
+        for regex in ["a*.b", "(a|b)*", "b b"]:
+            expected = tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+            for method in ["delta", "sources"]:
+                actual = tensor_based_rpq(
+                    regex,
+                    graph,
+                    start_nodes,
+                    final_nodes,
+                    closure_method=method,
+                    lazy=True,
+                )
+                assert actual == expected
+
+    def test_backends_agree(self, graph):
+        start_nodes, final_nodes = {0, 1, 4}, {0, 2, 5}
+        for regex in ["a*.b", "(a|b)*", "b b"]:
+            expected = tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+            for backend in BACKENDS:
+                for method in ["delta", "squaring", "sources"]:
+                    actual = tensor_based_rpq(
+                        regex,
+                        graph,
+                        start_nodes,
+                        final_nodes,
+                        closure_method=method,
+                        backend=backend,
+                    )
+                    assert actual == expected
+                for front_update in ["gather", "block_diag"]:
+                    actual = ms_bfs_based_rpq(
+                        regex,
+                        graph,
+                        start_nodes,
+                        final_nodes,
+                        backend=backend,
+                        front_update=front_update,
+                    )
+                    assert actual == expected
+                for direction in ["push", "pull", "auto"]:
+                    actual = ms_bfs_based_rpq(
+                        regex,
+                        graph,
+                        start_nodes,
+                        final_nodes,
+                        backend=backend,
+                        direction=direction,
+                    )
+                    assert actual == expected
+                for dense_visited_ratio in [0, 0.2, 2]:
+                    actual = ms_bfs_based_rpq(
+                        regex,
+                        graph,
+                        start_nodes,
+                        final_nodes,
+                        backend=backend,
+                        dense_visited_ratio=dense_visited_ratio,
+                    )
+                    assert actual == expected
+
+    def test_ms_bfs_chunks(self, graph):
+        for regex in ["a*.b", "(a|b)*", "b b"]:
+            expected = tensor_based_rpq(regex, graph, set(), set())
+            for chunk_size in [1, 3, 100]:
+                actual = ms_bfs_based_rpq(
+                    regex, graph, set(), set(), chunk_size=chunk_size
+                )
+                assert actual == expected
+            for memory_budget in [0, 2000, 10**9]:
+                actual = ms_bfs_based_rpq(
+                    regex, graph, set(), set(), memory_budget=memory_budget
+                )
+                assert actual == expected
+
+    def test_workers(self):
+        graph = labeled_two_cycles_graph(5, 6, labels=("a", "b"))
+        for regex in ["a*.b", "(a|b)*", "b b"]:
+            expected = tensor_based_rpq(regex, graph, set(), set())
+            assert tensor_based_rpq(regex, graph, set(), set(), workers=3) == expected
+            assert ms_bfs_based_rpq(regex, graph, set(), set(), workers=3) == expected
+
+    def test_ms_bfs_pair_array(self, graph):
+        expected = tensor_based_rpq("a*.b", graph, {0, 1}, set())
+        pairs = ms_bfs_based_rpq("a*.b", graph, {0, 1}, set(), as_array=True)
+        assert pairs.shape == (len(expected), 2)
+        assert set(map(tuple, pairs.tolist())) == expected
+
+        named = nx.relabel_nodes(graph, {node: f"v{node}" for node in graph.nodes})
+        assert ms_bfs_based_rpq("a*.b", named, {"v0", "v1"}, set()) == {
+            (f"v{u}", f"v{v}") for u, v in expected
+        }
+
+    def test_single_source_queries(self, graph):
+        for regex in ["a*.b", "a a", "(a|b)*", "b b b"]:
+            expected = tensor_based_rpq(regex, graph, set(), set())
+            for u in graph.nodes:
+                targets = rpq_targets(regex, graph, u)
+                assert len(targets) == len(set(targets))
+                assert {(u, v) for v in targets} == {
+                    pair for pair in expected if pair[0] == u
+                }
+                assert rpq_targets(regex, graph, u, limit=2) == targets[:2]
+                for v in graph.nodes:
+                    assert rpq_exists(regex, graph, u, v) == ((u, v) in expected)
+        assert not rpq_exists("a", graph, 0, 100)
+        assert rpq_targets("a", graph, 100) == []
+
+
+class TestPreparedGraph:
+    def test_rpq(self, graph):
+        prepared = PreparedGraph(graph)
+        assert prepared.number_of_nodes() == 8 and 0 in prepared
+        for regex in ["a*.b", "(a|b)*", "b b"]:
+            for starts, finals in [({0, 1}, set()), (set(), {2, 5}), ({3}, {0})]:
+                expected = tensor_based_rpq(regex, graph, starts, finals)
+                assert tensor_based_rpq(regex, prepared, starts, finals) == expected
+                assert ms_bfs_based_rpq(regex, prepared, starts, finals) == expected
+            assert rpq_targets(regex, prepared, 0) == rpq_targets(regex, graph, 0)
+            assert rpq_exists(regex, prepared, 0, 2) == rpq_exists(regex, graph, 0, 2)
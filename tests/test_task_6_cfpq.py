@@ -0,0 +1,95 @@
+from cfpq_data import labeled_two_cycles_graph
+from pyformlang.cfg import CFG, Variable
+import pytest
+
+from project.task3 import PreparedGraph
+from project.task6 import CompiledGrammar, hellings_based_cfpq
+from project.task7 import matrix_based_cfpq
+from project.task8 import cfg_to_rsm, tensor_based_cfpq
+from project.task9 import gll_based_cfpq
+
+GRAMMARS = [
+    "S -> a S b | a b",
+    "S -> a S b S | $",
+    "S -> S S | a | b",
+    "S -> A B\nA -> a A | $\nB -> b B | b",
+    "S -> A S B | A B\nA -> C C | a\nC -> a b | b a\nB -> D b\nD -> b | a a",
+]
+
+
+class TestCompiledGrammar:
+    def test_lookup_tables(self):
+        grammar = CompiledGrammar.from_cfg(CFG.from_text("S -> a S b | $"))
+        assert grammar.variables[grammar.start] == Variable("S")
+        assert grammar.nullable == [grammar.start]
+        assert set(grammar.terminal_heads) == {"a", "b"}
+        for (B, C), heads in grammar.body_heads.items():
+            assert all(0 <= var < len(grammar.variables) for var in (B, C, *heads))
+
+    def test_components_order(self):
+        for grammar in GRAMMARS:
+            compiled = CompiledGrammar.from_cfg(CFG.from_text(grammar))
+            computed = set()
+            for bodies in compiled.components():
+                heads = {head for heads in bodies.values() for head in heads}
+                assert not heads & computed
+                for B, C in bodies:
+                    for var in (B, C):
+                        assert (
+                            var in computed
+                            or var in heads
+                            or not any(
+                                var in heads for heads in compiled.body_heads.values()
+                            )
+                        )
+                computed |= heads
+
+    def test_reused_between_queries(self):
+        graph = PreparedGraph(labeled_two_cycles_graph(5, 6, labels=("a", "b")))
+        for grammar in GRAMMARS:
+            cfg = CFG.from_text(grammar)
+            compiled = CompiledGrammar.from_cfg(cfg)
+            for starts in [None, {0}, {1, 2}]:
+                expected = hellings_based_cfpq(cfg, graph, starts)
+                assert hellings_based_cfpq(compiled, graph, starts) == expected
+                assert matrix_based_cfpq(compiled, graph, starts) == expected
+
+    def test_useless_start_symbol(self):
+        graph = labeled_two_cycles_graph(2, 2, labels=("a", "b"))
+        cfg = CFG.from_text("S -> S a")
+        assert CompiledGrammar.from_cfg(cfg).start is None
+        assert hellings_based_cfpq(cfg, graph) == set()
+        assert matrix_based_cfpq(cfg, graph) == set()
+
+
+class TestHellings:
+    @pytest.mark.parametrize("grammar", GRAMMARS)
+    def test_agrees_with_other_algorithms(self, grammar):
+        graph = labeled_two_cycles_graph(20, 25, labels=("a", "b"))
+        cfg = CFG.from_text(grammar)
+        expected = matrix_based_cfpq(cfg, graph)
+        assert hellings_based_cfpq(cfg, graph) == expected
+        assert matrix_based_cfpq(cfg, graph, backend="bitpacked") == expected
+        assert tensor_based_cfpq(cfg_to_rsm(cfg), graph) == expected
+        assert hellings_based_cfpq(cfg, graph, {0, 3}, {5}) == {
+            (u, v) for u, v in expected if u in {0, 3} and v == 5
+        }
+
+
+class TestPreparedGraph:
+    def test_cfpq(self):
+        graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+        prepared = PreparedGraph(graph)
+        cfg = CFG.from_text("S -> a S b | a b | $")
+        rsm = cfg_to_rsm(cfg)
+        for starts, finals in [(None, None), ({0, 1}, None), (None, {0, 7})]:
+            expected = hellings_based_cfpq(cfg, graph, starts, finals)
+            assert hellings_based_cfpq(cfg, prepared, starts, finals) == expected
+            assert matrix_based_cfpq(cfg, prepared, starts, finals) == expected
+            assert tensor_based_cfpq(rsm, prepared, starts, finals) == expected
+            assert gll_based_cfpq(rsm, prepared, starts, finals) == expected
+
+        # closures must not leak into the shared graph matrices
+        automaton = prepared.automaton()
+        assert "S" not in automaton.adj_matrices
+        assert sum(m.count_nonzero() for m in automaton.adj_matrices.values()) == 9